@@ -0,0 +1,348 @@
+import copy
+from inspect import getargspec
+import numpy as np
+import torch
+from torch import optim
+import torch.multiprocessing as mp
+from utils import *
+from action_utils import *
+
+class ExperienceBuffer(object):
+    '''
+    Ring of episode slots in shared memory, written by actors and read by the learner.
+    Only slot indexes go through the queues.
+    Rows t of the info fields (alive_mask, senters, comm_action, agent_locs) are what the forward
+    of step t saw, so row t + 1 is the info after step t, row 0 the empty info of a new episode.
+    Rows past the length of an episode are left over from older episodes of the slot.
+    '''
+    fields = ('obs', 'action', 'behaviour_log_prob', 'reward', 'episode_mini_mask', 'alive_mask', 'senters',
+              'comm_action', 'agent_locs', 'has_locs', 'length', 'truncated')
+
+    def __init__(self, nslots, max_steps, nagents, obs_dim, dim_actions):
+        T, N = max_steps, nagents
+        def zeros(*shape):
+            return torch.zeros(nslots, *shape).share_memory_()
+        self.obs = zeros(T + 1, N, obs_dim)     # row T + 1 of an episode is the state it ended in
+        self.action = zeros(T, N, dim_actions)
+        self.behaviour_log_prob = zeros(T, N)   # log prob of the action under the actor's policy
+        self.reward = zeros(T, N)
+        self.episode_mini_mask = zeros(T, N)
+        self.alive_mask = zeros(T + 1, N)
+        self.senters = zeros(T + 1, N)  # channel outcome of the forward
+        self.comm_action = zeros(T + 1, N)
+        self.agent_locs = zeros(T + 1, N, 2)
+        self.has_locs = zeros(T + 1)
+        self.length = zeros()
+        self.truncated = zeros()    # episode cut by max_steps, bootstrap from its last state
+
+        self.free = mp.Queue()
+        self.full = mp.Queue()  # (slot, policy version of the actor, episode stat)
+        for i in range(nslots):
+            self.free.put(i)
+
+    def take(self, slot):
+        '''
+        Copy of the episode in slot, the slot goes back to the actors right away
+        output:
+            episode: dict of tensors, one per field
+        '''
+        episode = {name: getattr(self, name)[slot].clone() for name in self.fields}
+        self.free.put(slot)
+        return episode
+
+
+class Actor(mp.Process):
+    '''
+    Runs episodes with a snapshot of the shared policy_net, refreshed every actor_refresh episodes
+    '''
+    def __init__(self, id, args, policy_net, env_maker, buffer, version, epoch, stop, seed):
+        self.id = id
+        self.seed = seed
+        super(Actor, self).__init__()
+        self.args = args
+        self.policy_net = policy_net
+        self.env_maker = env_maker
+        self.buffer = buffer
+        self.version = version
+        self.epoch = epoch
+        self.stop = stop
+
+    def run(self):
+        torch.manual_seed(self.seed + self.id + 1)
+        np.random.seed(self.seed + self.id + 1)
+        self.env = self.env_maker()
+        self.net = copy.deepcopy(self.policy_net)
+        snapshot = -1
+        nepisodes = 0
+
+        while not self.stop.is_set():
+            if nepisodes % self.args.actor_refresh == 0:
+                snapshot = self.version.value
+                self.net.load_state_dict(self.policy_net.state_dict())
+            slot = self.buffer.free.get()
+            stat = self.run_episode(slot)
+            self.buffer.full.put((slot, snapshot, stat))
+            nepisodes += 1
+
+    def run_episode(self, slot):
+        '''
+        Trainer.get_episode without gradients, writing the episode into slot of the buffer
+        output:
+            stat: stat of the episode, like Trainer.get_episode
+        '''
+        args = self.args
+        buf = self.buffer
+        n = args.nagents
+        hard_attn = args.hard_attn and args.commnet
+
+        if 'epoch' in getargspec(self.env.reset).args:
+            state = self.env.reset(self.epoch.value)
+        else:
+            state = self.env.reset()
+        stat = dict()
+        info = dict()
+        if hard_attn:
+            info['comm_action'] = np.zeros(n, dtype=int)
+        buf.alive_mask[slot, 0] = 1
+        buf.comm_action[slot, 0] = 0
+        buf.has_locs[slot, 0] = 0
+        if args.recurrent:
+            if args.rnn_type == 'LSTM':
+                prev_hid = self.net.init_hidden(batch_size=1)
+            else:
+                prev_hid = torch.zeros(1, n, args.hid_size)
+
+        for t in range(args.max_steps):
+            buf.obs[slot, t] = state[0]
+            with torch.no_grad():
+                if args.recurrent:
+                    action_out, value, prev_hid = self.net([state, prev_hid], info)
+                else:
+                    action_out, value = self.net(state, info)
+            buf.senters[slot, t] = self.net.senters[0] if hasattr(self.net, 'senters') else 1
+
+            action = select_action(args, action_out)    # [heads][1, N, 1]
+            buf.behaviour_log_prob[slot, t] = sum(action_out[i][0].gather(1, action[i][0]).view(-1)
+                                                  for i in range(len(action_out)))
+            action, actual = translate_action(args, self.env, action)
+            next_state, reward, done, info = self.env.step(actual)
+
+            if hard_attn:
+                info['comm_action'] = action[-1] if not args.comm_action_one else np.ones(n, dtype=int)
+                stat['comm_action'] = stat.get('comm_action', 0) + info['comm_action'][:args.nfriendly]
+                if hasattr(args, 'enemy_comm') and args.enemy_comm:
+                    stat['enemy_comm'] = stat.get('enemy_comm', 0) + info['comm_action'][args.nfriendly:]
+                buf.comm_action[slot, t + 1] = torch.from_numpy(np.asarray(info['comm_action']).reshape(-1))
+
+            stat['reward'] = stat.get('reward', 0) + reward[:args.nfriendly]
+            if hasattr(args, 'enemy_comm') and args.enemy_comm:
+                stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward[args.nfriendly:]
+
+            buf.action[slot, t] = torch.from_numpy(np.stack([np.asarray(a).reshape(-1) for a in action], -1))
+            buf.reward[slot, t] = torch.from_numpy(reward)
+            buf.alive_mask[slot, t + 1] = torch.from_numpy(info['alive_mask'].reshape(-1)) if 'alive_mask' in info else 1
+            locs = self.net.get_agent_locs(info) if hasattr(self.net, 'get_agent_locs') else None
+            buf.has_locs[slot, t + 1] = locs is not None
+            if locs is not None:
+                buf.agent_locs[slot, t + 1] = torch.from_numpy(np.asarray(locs, dtype=float).reshape(n, 2))
+
+            truncated = not done and t == args.max_steps - 1
+            done = done or truncated
+            if not done and 'is_completed' in info:
+                buf.episode_mini_mask[slot, t] = torch.from_numpy(1 - info['is_completed'].reshape(-1))
+            else:
+                buf.episode_mini_mask[slot, t] = 1
+
+            state = next_state
+            if done:
+                break
+
+        buf.obs[slot, t + 1] = state[0]
+        buf.length[slot] = t + 1
+        buf.truncated[slot] = truncated
+        stat['num_steps'] = t + 1
+        stat['steps_taken'] = stat['num_steps']
+
+        reward = self.env.reward_terminal()
+        buf.reward[slot, t] += torch.from_numpy(np.asarray(reward, dtype=float))
+        stat['reward'] = stat.get('reward', 0) + reward[:args.nfriendly]
+        if hasattr(args, 'enemy_comm') and args.enemy_comm:
+            stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward[args.nfriendly:]
+
+        merge_stat(self.env.get_stat(), stat)
+        if hasattr(self.net, 'channel'):
+            merge_stat(self.net.channel.get_stat(), stat)
+        return stat
+
+
+class ActorLearnerTrainer(object):
+    '''
+    nprocesses-1 actors fill the experience buffer with episodes from policy snapshots,
+    this process learns from them in large batches with V-trace off-policy correction.
+    '''
+    def __init__(self, args, policy_net, env_maker):
+        if args.continuous:
+            raise RuntimeError("actor/learner training supports discrete actions only")
+        self.args = args
+        self.policy_net = policy_net
+        self.optimizer = optim.RMSprop(policy_net.parameters(),
+            lr = args.lrate, alpha=0.97, eps=1e-6)
+        self.params = [p for p in self.policy_net.parameters()]
+
+        self.nactors = args.nprocesses - 1
+        # the learner copies episodes out as it takes them, so slots only hold the episodes
+        # the actors are ahead by, about two updates worth
+        nslots = 2 * (-(-args.batch_size * self.nactors // args.max_steps) + self.nactors)
+        self.buffer = ExperienceBuffer(nslots, args.max_steps, args.nagents, args.num_inputs, args.dim_actions)
+        self.version = mp.Value('i', 0)     # number of updates applied to policy_net
+        self.epoch = mp.Value('i', 0)
+        self.stop = mp.Event()
+        for i in range(self.nactors):
+            actor = Actor(i, args, policy_net, env_maker, self.buffer, self.version, self.epoch, self.stop, seed=args.seed)
+            actor.start()
+
+    def quit(self):
+        self.stop.set()
+
+    def train_batch(self, epoch):
+        '''
+        output:
+            stat: stat of the episodes learned from, at least batch_size steps per actor
+        '''
+        self.epoch.value = epoch
+        episodes = []
+        stat = dict()
+        stat['num_episodes'] = 0
+        nsteps = 0
+        while nsteps < self.args.batch_size * self.nactors:
+            slot, snapshot, s = self.buffer.full.get()
+            s['policy_lag'] = self.version.value - snapshot
+            merge_stat(s, stat)
+            stat['num_episodes'] += 1
+            nsteps += s['num_steps']
+            episodes.append(self.buffer.take(slot))
+        stat['num_steps'] = nsteps
+
+        self.optimizer.zero_grad()
+        s = self.compute_grad(episodes)
+        merge_stat(s, stat)
+        for p in self.params:
+            if p._grad is not None:
+                p._grad.data /= stat['num_steps']
+        self.optimizer.step()
+        with self.version.get_lock():
+            self.version.value += 1
+        return stat
+
+    def compute_grad(self, episodes):
+        '''
+        Replays the episodes side by side with one batched forward per time step,
+        then V-trace targets and policy gradient, Trainer.compute_grad otherwise.
+        input:
+            episodes: list of ExperienceBuffer.take() copies
+        '''
+        args = self.args
+        stat = dict()
+        n = args.nagents
+        B = len(episodes)
+        length = torch.stack([e['length'] for e in episodes]).long()
+        T = int(length.max())
+        hard_attn = args.hard_attn and args.commnet
+
+        def field(name, steps):
+            # time major, [steps, B, ...]
+            return torch.stack([e[name][:steps] for e in episodes]).transpose(0, 1)
+        obs = field('obs', T + 1)
+        alive_mask = field('alive_mask', T + 1)
+        senters = field('senters', T + 1)
+        comm_action = field('comm_action', T + 1)
+        agent_locs = field('agent_locs', T + 1)
+        has_locs = field('has_locs', T + 1)
+        actions = field('action', T).long()     # [T, B, N, heads]
+        rewards = field('reward', T)
+        behaviour_log_prob = field('behaviour_log_prob', T)
+        episode_mini_mask = field('episode_mini_mask', T)
+        truncated = torch.stack([e['truncated'] for e in episodes])
+
+        if args.recurrent:
+            if args.rnn_type == 'LSTM':
+                prev_hid = self.policy_net.init_hidden(batch_size=B)
+            else:
+                prev_hid = torch.zeros(B, n, args.hid_size)
+        log_probs, values, entropy = [], [], 0
+        for t in range(T + 1):
+            info = {'alive_mask': alive_mask[t].numpy(), 'channel_senters': senters[t]}
+            if hard_attn:
+                info['comm_action'] = comm_action[t].long().numpy()
+            # row t of an episode is its info for t <= length, later rows are stale
+            if has_locs[t][t <= length].all():
+                info['agent_locs'] = agent_locs[t].numpy()
+            if args.recurrent:
+                action_out, value, prev_hid = self.policy_net([obs[t], prev_hid], info)
+                if (t + 1) % args.detach_gap == 0:
+                    if args.rnn_type == 'LSTM':
+                        prev_hid = (prev_hid[0].detach(), prev_hid[1].detach())
+                    else:
+                        prev_hid = prev_hid.detach()
+            else:
+                action_out, value = self.policy_net(obs[t], info)
+            values.append(value.view(B, n))
+            if t < T:
+                log_p_a = [a.view(B, n, -1) for a in action_out]
+                log_probs.append(sum(log_p_a[i].gather(2, actions[t, :, :, i:i+1]).squeeze(2)
+                                     for i in range(len(log_p_a))))
+                valid = (t < length).to(value.dtype).view(B, 1, 1)
+                for a in log_p_a:
+                    entropy -= (a * a.exp() * valid).sum()
+        log_probs = torch.stack(log_probs)  # [T, B, N]
+        values = torch.stack(values)    # [T + 1, B, N]
+
+        steps = torch.arange(T).view(T, 1)
+        valid = (steps < length.view(1, B)).to(values.dtype).unsqueeze(2)  # [T, B, 1]
+        cont = (steps < length.view(1, B) - 1).to(values.dtype).unsqueeze(2)  # episode goes on after t
+        # the last state where max_steps cut the episode is bootstrapped from
+        bootstrap = (valid - cont) * truncated.view(1, B, 1)
+        alive_masks = alive_mask[1:] * valid  # alive after each step, as in Trainer.compute_grad
+
+        # V-trace with truncated importance weights, rho_bar = c_bar = 1, lambda = tau
+        ratios = (log_probs.data - behaviour_log_prob).exp()
+        rhos = ratios.clamp(max=1)
+        cs = args.tau * ratios.clamp(max=1)
+
+        def vtrace(rewards, cont):
+            # next value in the episode, the bootstrap value where max_steps cut it, 0 at the end
+            next_values = values.data[1:] * (cont + bootstrap)
+            deltas = rhos * (rewards + args.gamma * next_values - values.data[:-1])
+            vs = values.data[:-1] + discounted_returns(deltas * valid, args.gamma * cs * cont)
+            next_vs = torch.cat([vs[1:], torch.zeros_like(vs[:1])]) * cont + values.data[1:] * bootstrap
+            advantages = rhos * (rewards + args.gamma * next_vs - values.data[:-1])
+            return vs, advantages
+
+        # per agent traces also end where an agent completed and its slot is reused, as in Trainer.compute_grad
+        coop_vs, coop_advantages = vtrace(rewards.mean(2, keepdim=True).expand_as(rewards), cont)
+        ncoop_vs, ncoop_advantages = vtrace(rewards, cont * episode_mini_mask)
+        vs = (args.mean_ratio * coop_vs) + ((1 - args.mean_ratio) * ncoop_vs)
+        advantages = (args.mean_ratio * coop_advantages) + ((1 - args.mean_ratio) * ncoop_advantages)
+
+        if args.normalize_rewards:
+            adv = advantages[alive_masks > 0]
+            advantages = (advantages - adv.mean()) / adv.std()
+
+        action_loss = -(advantages * log_probs * alive_masks).sum()
+        stat['action_loss'] = action_loss.item()
+        value_loss = ((values[:-1] - vs).pow(2) * alive_masks).sum()
+        stat['value_loss'] = value_loss.item()
+        loss = action_loss + args.value_coeff * value_loss
+
+        stat['entropy'] = entropy.item()
+        if args.entr > 0:
+            loss -= args.entr * entropy
+
+        loss.backward()
+        return stat
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state):
+        self.optimizer.load_state_dict(state)
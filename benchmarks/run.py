@@ -0,0 +1,346 @@
+'''
+Benchmarks of the hot paths of training, for a range of agent counts and grid sizes.
+Each case runs in its own forked process, which starts with the modules of this one loaded. Its memory is
+how far the peak RSS grew past the RSS it started with. Results are saved as JSON,
+pass the file of an older version with --compare to see what got faster or slower.
+
+    python benchmarks/run.py --nagents 5 10 20 --dims 14 18 --out bench.json
+    python benchmarks/run.py --cases channel forward --compare bench.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import gym
+import ic3net_envs
+import data
+from comm import CommNetMLP
+from trainer import Trainer
+from channel import make_channel
+from action_utils import parse_action_args
+
+torch.set_default_tensor_type('torch.DoubleTensor')
+
+ENV_IDS = {'traffic_junction': 'TrafficJunction-v0', 'predator_prey': 'PredatorPrey-v0'}
+
+
+def make_args(env_name, nagents, dim, opts):
+    '''
+    Namespace like the one main.py builds: env defaults from the env's init_args, then the options
+    of this benchmark run, for a recurrent CommNet
+    '''
+    parser = argparse.ArgumentParser()
+    gym.make(ENV_IDS[env_name]).init_args(parser)
+    args = parser.parse_args([])
+    args.env_name = env_name
+    args.nagents = nagents
+    args.dim = dim
+    if env_name == 'traffic_junction':
+        args.difficulty = opts.difficulty
+        args.vision = 0
+    for key, value in dict(hid_size=opts.hid_size, max_steps=opts.max_steps, batch_size=opts.batch_size,
+                           nprocesses=1, recurrent=True, rnn_type='LSTM', detach_gap=10, commnet=True,
+                           ic3net=False, random=False, comm_mode='avg', comm_passes=1, comm_mask_zero=False,
+                           comm_init='uniform', hard_attn=False, comm_action_one=False, share_weights=False,
+                           comm_neighbors=0, comm_radius=-1, channel=opts.channel, gamma=1.0, tau=1.0, gae=False,
+                           seed=opts.seed, normalize_rewards=False, lrate=0.001, entr=0, value_coeff=0.01,
+                           mean_ratio=1.0, advantages_per_action=False, nactions='1', action_scale=1.0,
+                           display=False, plot=False).items():
+        setattr(args, key, value)
+
+    args.nfriendly = args.nagents
+    if hasattr(args, 'enemy_comm') and args.enemy_comm:
+        args.nagents += args.nenemies
+    env = data.init(env_name, args, False)
+    args.num_inputs = env.observation_dim
+    args.num_actions = [env.num_actions]
+    args.dim_actions = env.dim_actions
+    parse_action_args(args)
+    return args
+
+
+def measure(fn, min_time):
+    '''
+    Call fn until min_time seconds passed, fn returns the number of steps it did
+    output:
+        steps, seconds
+    '''
+    fn()    # warm up
+    steps = 0
+    start = time.time()
+    while time.time() - start < min_time:
+        steps += fn()
+    return steps, time.time() - start
+
+
+def bench_channel(nagents, dim, opts):
+    '''
+    Channel.send, one contention phase per row of a [batch, nagents] mask of alive agents
+    '''
+    args = argparse.Namespace(channel=opts.channel, nagents=nagents)
+    channel = make_channel(args)
+    alive = np.ones((opts.nenvs, nagents))
+    if channel.native_torch:
+        alive = torch.from_numpy(alive)
+
+    def send():
+        if channel.batched:
+            channel.send(alive)
+        else:
+            for m in alive:
+                channel.send(m)
+        return len(alive)
+    steps, seconds = measure(send, opts.min_time)
+    return dict(steps=steps, seconds=seconds)
+
+
+def bench_forward(nagents, dim, opts):
+    '''
+    CommNetMLP.forward of nenvs envs, without grad
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    net = CommNetMLP(args, args.num_inputs)
+    B = opts.nenvs
+    x = torch.randn(B, nagents, args.num_inputs)
+    hid = net.init_hidden(batch_size=B)
+    info = {'alive_mask': np.ones((B, nagents))}
+
+    def forward():
+        with torch.no_grad():
+            net([x, hid], info)
+        return B
+    steps, seconds = measure(forward, opts.min_time)
+    return dict(steps=steps, seconds=seconds, latency_ms=1000 * seconds * B / steps)
+
+
+def bench_env_step(env_name):
+    '''
+    output:
+        bench: step of the raw env with random actions, reset when an episode ends
+    '''
+    def bench(nagents, dim, opts):
+        args = make_args(env_name, nagents, dim, opts)
+        env = data.init(env_name, args)
+        env.reset(0)
+        t = [0]
+
+        def step():
+            _, _, done, _ = env.env.step(np.random.randint(env.num_actions, size=args.nagents))
+            t[0] += 1
+            if done or t[0] == args.max_steps:
+                env.reset(0)
+                t[0] = 0
+            return 1
+        steps, seconds = measure(step, opts.min_time)
+        return dict(steps=steps, seconds=seconds)
+    return bench
+
+
+def bench_tj_batch_step(nagents, dim, opts):
+    '''
+    BatchVectorEnv.step of nenvs traffic junction instances, steps are the instance steps
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    env = data.init_vector('traffic_junction', args, opts.nenvs, batched=True)
+    env.reset(0)
+
+    def step():
+        env.step([[np.random.randint(env.num_actions, size=nagents)] for _ in range(opts.nenvs)])
+        return opts.nenvs
+    steps, seconds = measure(step, opts.min_time)
+    return dict(steps=steps, seconds=seconds)
+
+
+def bench_get_obs(nagents, dim, opts):
+    '''
+    TrafficJunctionEnv._get_obs, midway through an episode
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    env = data.init('traffic_junction', args)
+    env.reset(0)
+    for _ in range(args.max_steps // 2):
+        env.env.step(np.random.randint(env.num_actions, size=nagents))
+
+    def get_obs():
+        env.env._get_obs()
+        return 1
+    steps, seconds = measure(get_obs, opts.min_time)
+    return dict(steps=steps, seconds=seconds)
+
+
+def bench_flatten_obs(nagents, dim, opts):
+    '''
+    GymWrapper._flatten_obs of a traffic junction observation
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    env = data.init('traffic_junction', args)
+    env.reset(0)
+    obs = env.env._get_obs()
+
+    def flatten_obs():
+        env._flatten_obs(obs)
+        return 1
+    steps, seconds = measure(flatten_obs, opts.min_time)
+    return dict(steps=steps, seconds=seconds)
+
+
+def bench_compute_grad(nagents, dim, opts):
+    '''
+    Trainer.compute_grad, steps are the rows of the batches.
+    The graph of a batch can only be backpropagated once, so each call gets a new batch, not timed
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    trainer = Trainer(args, CommNetMLP(args, args.num_inputs), data.init('traffic_junction', args))
+    steps, seconds = -1, 0
+    while seconds < opts.min_time:
+        batch, stat = trainer.run_batch(0)
+        trainer.optimizer.zero_grad()
+        start = time.time()
+        trainer.compute_grad(batch)
+        if steps < 0:   # warm up
+            steps = 0
+            continue
+        seconds += time.time() - start
+        steps += stat['num_steps']
+    return dict(steps=steps, seconds=seconds)
+
+
+def bench_train_batch(nagents, dim, opts):
+    '''
+    Trainer.train_batch: episodes, compute_grad and the update
+    '''
+    args = make_args('traffic_junction', nagents, dim, opts)
+    trainer = Trainer(args, CommNetMLP(args, args.num_inputs), data.init('traffic_junction', args))
+    steps, seconds = measure(lambda: trainer.train_batch(0)['num_steps'], opts.min_time)
+    return dict(steps=steps, seconds=seconds)
+
+
+# name -> (benchmark, whether it depends on the grid size)
+CASES = {
+    'channel': (bench_channel, False),
+    'forward': (bench_forward, True),
+    'tj_step': (bench_env_step('traffic_junction'), True),
+    'tj_batch_step': (bench_tj_batch_step, True),
+    'tj_get_obs': (bench_get_obs, True),
+    'pp_step': (bench_env_step('predator_prey'), True),
+    'flatten_obs': (bench_flatten_obs, True),
+    'compute_grad': (bench_compute_grad, True),
+    'train_batch': (bench_train_batch, True),
+}
+
+
+def run_case(name, nagents, dim, opts, comm):
+    # kilobytes on linux. The peak of a forked process starts at its RSS, the imports it inherits
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    torch.manual_seed(opts.seed)
+    np.random.seed(opts.seed)
+    try:
+        result = CASES[name][0](nagents, dim, opts)
+    except Exception as e:
+        result = dict(error='{}: {}'.format(type(e).__name__, e))
+    result['peak_mem_mb'] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024
+    comm.send(result)
+
+
+def run(opts):
+    results = []
+    for name in opts.cases:
+        if name not in CASES:
+            raise RuntimeError("wrong case name, available cases: [{}]".format('|'.join(CASES)))
+        dims = opts.dims if CASES[name][1] else [None]
+        for nagents in opts.nagents:
+            for dim in dims:
+                comm, comm_remote = mp.Pipe()
+                process = mp.Process(target=run_case, args=(name, nagents, dim, opts, comm_remote))
+                process.start()
+                result = comm.recv()
+                process.join()
+                result.update(case=name, nagents=nagents, dim=dim)
+                if 'error' not in result:
+                    result['steps_per_sec'] = result['steps'] / result['seconds']
+                results.append(result)
+                report(result)
+    return results
+
+
+def report(result, old=None):
+    line = '{:<14} nagents {:<4} dim {:<5}'.format(result['case'], result['nagents'], str(result['dim']))
+    if 'error' in result:
+        print('{} {}'.format(line, result['error']))
+        return
+    line += ' {:>12.1f} steps/s  peak +{:>7.1f} MB'.format(result['steps_per_sec'], result['peak_mem_mb'])
+    if 'latency_ms' in result:
+        line += '  latency {:.3f} ms'.format(result['latency_ms'])
+    if old is not None and 'steps_per_sec' in old:
+        line += '  x{:.2f} vs old'.format(result['steps_per_sec'] / old['steps_per_sec'])
+    print(line)
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the training hot paths')
+    parser.add_argument('--cases', nargs='+', default=list(CASES),
+                        help='cases to run [{}]'.format('|'.join(CASES)))
+    parser.add_argument('--nagents', nargs='+', type=int, default=[5, 10, 20],
+                        help='agent counts')
+    parser.add_argument('--dims', nargs='+', type=int, default=[14],
+                        help='grid sizes, traffic junction needs even sizes for easy and medium')
+    parser.add_argument('--difficulty', default='medium', type=str,
+                        help='traffic junction difficulty, easy|medium|hard')
+    parser.add_argument('--channel', default='csma_loop', type=str,
+                        help='channel of the model, and the one the channel case sends on')
+    parser.add_argument('--nenvs', default=1, type=int,
+                        help='envs per forward, instances of the batched env and contention phases per send')
+    parser.add_argument('--hid_size', default=128, type=int,
+                        help='hidden layer size')
+    parser.add_argument('--max_steps', default=40, type=int,
+                        help='episode length')
+    parser.add_argument('--batch_size', default=500, type=int,
+                        help='steps per batch of compute_grad and train_batch')
+    parser.add_argument('--min_time', default=2.0, type=float,
+                        help='seconds to run each case for')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='random seed')
+    parser.add_argument('--out', default='', type=str,
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', default='', type=str,
+                        help='JSON results of another version to compare with')
+    opts = parser.parse_args()
+
+    results = run(opts)
+
+    if opts.compare != '':
+        with open(opts.compare) as f:
+            old = {(r['case'], r['nagents'], r['dim']): r for r in json.load(f)['results']}
+        print('\ncompared with {}'.format(opts.compare))
+        for result in results:
+            report(result, old.get((result['case'], result['nagents'], result['dim'])))
+
+    if opts.out != '':
+        meta = dict(version=version(), time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                    torch=torch.__version__, numpy=np.__version__, machine=platform.machine(),
+                    cpus=os.cpu_count(), options=vars(opts))
+        with open(opts.out, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,28 @@
+import os
 import random
 import numpy as np
 import torch
+
+# on-disk cache of precomputed channel tables, override with IC3NET_CACHE
+CACHE_DIR = os.environ.get('IC3NET_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ic3net'))
+
 class Channel:
     '''
     Communication channel class
     '''
-    def __init__(self) -> None:
-        self.comm_pahse = 60    # length of commu phase, each time slot counts 1
+    extra_args = ()
+    native_torch = False
+    batched = False     # send() takes [B,N] masks
+
+    def __init__(self, comm_pahse=60, frame_slots=10, init_window=3, max_window=15) -> None:
+        self.comm_pahse = comm_pahse    # length of commu phase, each time slot counts 1
         # self.DIFS = 3
         # self.EIFS = 3
         self.windows = {}
-        self.frame_slots = 10
+        self.frame_slots = frame_slots
+        self.init_window = init_window  # initial window width
+        self.max_window = max_window    # BEB cap
+        self.stat = dict()
         
     def send(self, agent_mask):
         '''
@@ -24,11 +36,12 @@ class Channel:
         self.alive_index = (np.nonzero(agent_mask.squeeze())[0]).tolist()  # np.nonzero() returns a tuple of indexes of nonzero elements on each dimension
         # we hope np.array --> list of nonzero element positions
         if len(self.alive_index) == 0:  # all dead
+            self.record(channel_phases=1, channel_contenders=0, channel_idle_slots=self.comm_pahse)
             return agent_mask.copy(), [], []
         else:
             self.windows.clear()    # clear windows
             for x in self.alive_index:
-                self.windows[x] = 3     # initial window width: 3
+                self.windows[x] = self.init_window
             sent, failed = self.step()
             senters = agent_mask.copy()    # numpy array
             for x in failed:
@@ -45,6 +58,8 @@ class Channel:
         not_sent_yet = self.alive_index.copy()
         waits = {}
         who_sent = []
+        stages = dict.fromkeys(not_sent_yet, 0)   # backoff stage of each agent
+        rounds = attempts = collisions = 0
         for x in not_sent_yet:
             waits[x] = random.randint(0, self.windows[x])    # generate random wait time [low, high]
         while phase > 0:
@@ -56,7 +71,10 @@ class Channel:
                     break
                 else:
                     phase -= (min_wait + self.frame_slots)
-                    if list(waits.values()).count(min_wait) == 1:   # no collision. the message can be sent successfully
+                    num_at_min = list(waits.values()).count(min_wait)
+                    rounds += 1
+                    attempts += num_at_min
+                    if num_at_min == 1:   # no collision. the message can be sent successfully
                         to_del = 0
                         for key in waits.keys():
                             if waits[key] == min_wait:
@@ -68,6 +86,7 @@ class Channel:
                         del waits[to_del]   # agent key has sent
                     
                     else:   # collision happens
+                        collisions += 1
                         to_change = []
                         for key in waits.keys():
                             if waits[key] == min_wait:
@@ -75,9 +94,418 @@ class Channel:
                             else:
                                 waits[key] -= min_wait
                         for x in to_change:
-                            self.windows[x] = min([15, 2*(self.windows[x]+1) - 1])    # BEB
+                            stages[x] += 1
+                            self.windows[x] = min([self.max_window, 2*(self.windows[x]+1) - 1])    # BEB
                             waits[x] = random.randint(0, self.windows[x])    # regenerate random wait time   
+        self.record(channel_phases=1, channel_contenders=len(self.alive_index), channel_attempts=attempts,
+                    channel_successes=len(who_sent), channel_collisions=collisions,
+                    channel_idle_slots=self.comm_pahse - rounds * self.frame_slots,
+                    channel_backoff=np.bincount(list(stages.values()), minlength=self.max_stages()))
         if len(not_sent_yet) == 0:
             return who_sent, []
         else:
-            return who_sent, list(set(self.alive_index) - set(who_sent))    # difference set
\ No newline at end of file
+            return who_sent, list(set(self.alive_index) - set(who_sent))    # difference set
+
+    def max_stages(self):
+        # every transmission round takes at least frame_slots
+        return self.comm_pahse // self.frame_slots + 1
+
+    def record(self, **counters):
+        for k, v in counters.items():
+            self.stat[k] = self.stat.get(k, 0) + v
+
+    def get_stat(self):
+        '''
+        output:
+            stat: counters accumulated since last call, summed over phases
+                {
+                    'channel_phases': number of contention phases simulated
+                    'channel_contenders': alive agents contending for the channel
+                    'channel_attempts': transmissions, including collided ones
+                    'channel_successes': messages sent successfully
+                    'channel_collisions': transmission rounds with a collision
+                    'channel_idle_slots': time slots not used for transmitting
+                    'channel_backoff': histogram of the backoff stage each contender ended in
+                }
+            models only report the counters that are meaningful for them
+        '''
+        stat = self.stat
+        self.stat = dict()
+        return stat
+
+
+class BatchChannel(Channel):
+    '''
+    Vectorized communication channel, numpy version of Channel.
+    Simulates one independent contention phase per row of agent_mask at once.
+    Base class of the vectorized MAC models, which override step().
+    '''
+    batched = True
+
+    def send(self, agent_mask, env_ids=None):
+        '''
+        input:
+            agent_mask: numpy array([B, N]) or ([N,]), i.e. info['alive_mask'] of each env in batch
+            env_ids: array([B,]), the env of each row, for models keeping state per env. Rows 0..B-1 by default
+        output:
+            senters: an array like agent_mask, but set failed agents silent
+            sent: bool array like agent_mask, True for agents that sent messages successfully
+            failed: bool array like agent_mask, True for alive agents that failed to send messages
+        '''
+        alive = np.atleast_2d(agent_mask) != 0
+        self.env_ids = np.arange(alive.shape[0]) if env_ids is None else np.asarray(env_ids).reshape(-1)
+        sent = self.step(alive)
+        failed = alive & ~sent
+        senters = agent_mask.copy()
+        senters[failed.reshape(senters.shape)] = 0
+        return senters, sent.reshape(agent_mask.shape), failed.reshape(agent_mask.shape)
+
+    def step(self, alive):
+        '''
+        input:
+            alive: bool array([B, N]), agents contending for the channel in each phase
+        output:
+            sent: bool array([B, N]), agents that sent messages successfully
+        '''
+        phase = np.full((alive.shape[0], 1), self.comm_pahse)
+        windows = np.full(alive.shape, self.init_window)
+        waits = self._backoff(windows)
+        pending = alive.copy()
+        sent = np.zeros_like(alive)
+        stages = np.zeros(alive.shape, dtype=int)
+        rounds = attempts = collisions = 0
+        # every round takes at least frame_slots, so this runs at most comm_pahse // frame_slots times
+        while True:
+            # agents not contending wait past the end of the phase
+            waits = np.where(pending, waits, self.comm_pahse)
+            min_wait = waits.min(axis=1, keepdims=True)
+            # phases with enough time to transmit another message
+            active = phase >= min_wait + self.frame_slots
+            if not active.any():
+                break
+            phase = np.where(active, phase - min_wait - self.frame_slots, phase)
+            at_min = (waits == min_wait) & active
+            num_at_min = at_min.sum(axis=1, keepdims=True)
+            rounds += active.sum()
+            attempts += num_at_min.sum()
+            collisions += (num_at_min > 1).sum()
+
+            # the rest of contending agents count down
+            waits = np.where(active, waits - min_wait, waits)
+
+            # no collision. the message can be sent successfully
+            success = at_min & (num_at_min == 1)
+            sent |= success
+            pending &= ~success
+
+            # collision happens, BEB and regenerate random wait time
+            collided = at_min & (num_at_min > 1)
+            if collided.any():
+                stages += collided
+                windows = np.where(collided, np.minimum(self.max_window, 2 * (windows + 1) - 1), windows)
+                waits = np.where(collided, self._backoff(windows), waits)
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(), channel_attempts=attempts,
+                    channel_successes=sent.sum(), channel_collisions=collisions,
+                    channel_idle_slots=alive.shape[0] * self.comm_pahse - rounds * self.frame_slots,
+                    channel_backoff=np.bincount(stages[alive], minlength=self.max_stages()))
+        return sent
+
+    def _backoff(self, windows):
+        # uniform random wait time in [0, window]
+        return np.floor(np.random.random(windows.shape) * (windows + 1)).astype(int)
+
+
+class TableChannel(BatchChannel):
+    '''
+    Communication channel sampled from a precomputed outcome table of BatchChannel.
+    Agents are exchangeable, so the outcome of a phase only depends on the number of
+    alive agents n: draw k successes from P(k | n), then k of the n alive agents uniformly.
+    '''
+    extra_args = ('nagents',)
+
+    def __init__(self, nagents, nsamples=100000, **kwargs) -> None:
+        super(TableChannel, self).__init__(**kwargs)
+        self.nagents = nagents
+        self.nsamples = nsamples
+        self.table = self.load_table()
+        self.stat = dict()  # drop counters of building the table
+        self.cdf = np.cumsum(self.table, axis=1)
+
+    def table_path(self):
+        name = 'channel_{}_{}_{}_{}_{}_{}.npy'.format(self.comm_pahse, self.frame_slots, self.init_window,
+                                                     self.max_window, self.nagents, self.nsamples)
+        return os.path.join(CACHE_DIR, name)
+
+    def load_table(self):
+        '''
+        output:
+            table: numpy array([nagents+1, nagents+1]), table[n, k] = P(k of n alive agents send successfully)
+        '''
+        path = self.table_path()
+        if os.path.exists(path):
+            return np.load(path)
+        table = self.build_table()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmp_path, path)  # atomic, several processes may build the same table
+        return table
+
+    def build_table(self):
+        table = np.zeros((self.nagents + 1, self.nagents + 1))
+        table[0, 0] = 1
+        for n in range(1, self.nagents + 1):
+            sent = BatchChannel.step(self, np.ones((self.nsamples, n), dtype=bool))
+            table[n, :n + 1] = np.bincount(sent.sum(axis=1), minlength=n + 1) / self.nsamples
+        return table
+
+    def step(self, alive):
+        '''
+        input:
+            alive: bool array([B, N]), agents contending for the channel in each phase
+        output:
+            sent: bool array([B, N]), agents that sent messages successfully
+        '''
+        num_alive = alive.sum(axis=1)
+        u = np.random.random((alive.shape[0], 1))
+        num_sent = (u > self.cdf[num_alive]).sum(axis=1)
+        # random rank of every alive agent, dead agents rank last
+        keys = np.where(alive, np.random.random(alive.shape), 2)
+        ranks = np.argsort(np.argsort(keys, axis=1), axis=1)
+        # the table only knows outcomes, not the contention that led to them
+        self.record(channel_phases=alive.shape[0], channel_contenders=num_alive.sum(), channel_successes=num_sent.sum())
+        return ranks < num_sent[:, None]
+
+
+class IdealChannel(BatchChannel):
+    '''
+    Lossless channel, every alive agent sends successfully.
+    '''
+    def step(self, alive):
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(),
+                    channel_attempts=alive.sum(), channel_successes=alive.sum())
+        return alive.copy()
+
+
+class BernoulliChannel(BatchChannel):
+    '''
+    Every alive agent independently loses its message with probability loss_rate.
+    '''
+    extra_args = ('loss_rate',)
+
+    def __init__(self, loss_rate=0.1, **kwargs) -> None:
+        super(BernoulliChannel, self).__init__(**kwargs)
+        self.loss_rate = loss_rate
+
+    def step(self, alive):
+        sent = alive & (np.random.random(alive.shape) >= self.loss_rate)
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(),
+                    channel_attempts=alive.sum(), channel_successes=sent.sum())
+        return sent
+
+
+class AlohaChannel(BatchChannel):
+    '''
+    Slotted ALOHA, the phase is split into comm_pahse // frame_slots frames and every
+    agent that has not sent yet transmits in each frame with probability tx_prob.
+    '''
+    extra_args = ('tx_prob',)
+
+    def __init__(self, tx_prob=0.3, **kwargs) -> None:
+        super(AlohaChannel, self).__init__(**kwargs)
+        self.tx_prob = tx_prob
+
+    def step(self, alive):
+        pending = alive.copy()
+        sent = np.zeros_like(alive)
+        attempts = collisions = idle_frames = 0
+        nframes = self.comm_pahse // self.frame_slots
+        for _ in range(nframes):
+            tx = pending & (np.random.random(alive.shape) < self.tx_prob)
+            num_tx = tx.sum(axis=1, keepdims=True)
+            # no collision in this frame
+            success = tx & (num_tx == 1)
+            sent |= success
+            pending &= ~success
+            attempts += num_tx.sum()
+            collisions += (num_tx > 1).sum()
+            idle_frames += (num_tx == 0).sum()
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(), channel_attempts=attempts,
+                    channel_successes=sent.sum(), channel_collisions=collisions,
+                    channel_idle_slots=idle_frames * self.frame_slots
+                    + alive.shape[0] * (self.comm_pahse - nframes * self.frame_slots))
+        return sent
+
+
+class TDMAChannel(BatchChannel):
+    '''
+    Round-robin TDMA, the comm_pahse // frame_slots frames of a phase are given to alive
+    agents in index order, starting after the last agent served in the previous phase.
+    Each env has its own round-robin, keyed by the env_ids given to send().
+    '''
+    def __init__(self, **kwargs) -> None:
+        super(TDMAChannel, self).__init__(**kwargs)
+        self.offset = np.zeros(0, dtype=int)    # first agent of the next phase of each env
+
+    def step(self, alive):
+        B, n = alive.shape
+        nframes = self.comm_pahse // self.frame_slots
+        env_ids = self.env_ids
+        if env_ids.max() >= len(self.offset):
+            # new envs start from agent 0
+            self.offset = np.concatenate([self.offset, np.zeros(env_ids.max() + 1 - len(self.offset), dtype=int)])
+        # position of every agent in the round-robin order, dead agents last
+        order = np.where(alive, (np.arange(n) - self.offset[env_ids, None]) % n, n)
+        ranks = np.argsort(np.argsort(order, axis=1), axis=1)
+        sent = alive & (ranks < nframes)
+        # the next phase starts after the last agent served, envs with no alive agent keep their offset
+        served = sent.any(axis=1)
+        last = np.where(sent, ranks, -1).argmax(axis=1)
+        self.offset[env_ids[served]] = (last[served] + 1) % n
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(), channel_attempts=sent.sum(),
+                    channel_successes=sent.sum(), channel_collisions=0,
+                    channel_idle_slots=alive.shape[0] * self.comm_pahse - sent.sum() * self.frame_slots)
+        return sent
+
+
+class TorchChannel(BatchChannel):
+    '''
+    Torch version of BatchChannel, consumes and returns tensors on the device of agent_mask
+    so the mask path of CommNetMLP needs no numpy round-trip.
+    Random numbers come from a torch.Generator on that device seeded with channel_seed, or from the
+    global torch generator of the device (seeded per process) when channel_seed < 0.
+    On an accelerator nothing leaves the device while simulating, counters are moved to the host in get_stat().
+    On the cpu the contention loop stops as soon as every phase has ended.
+    '''
+    extra_args = ('channel_seed',)
+    native_torch = True
+
+    def __init__(self, channel_seed=-1, **kwargs) -> None:
+        super(TorchChannel, self).__init__(**kwargs)
+        self.channel_seed = channel_seed
+        self.generator = None
+
+    def get_generator(self, device):
+        '''
+        output: generator on device, None for the global one. Seeded again if the device changes
+        '''
+        if self.channel_seed >= 0 and (self.generator is None or self.generator.device != device):
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.channel_seed)
+        return self.generator
+
+    def get_stat(self):
+        stat = super(TorchChannel, self).get_stat()
+        for k, v in stat.items():
+            if torch.is_tensor(v):
+                stat[k] = v.item() if v.dim() == 0 else v.cpu().numpy()
+        return stat
+
+    def send(self, agent_mask, env_ids=None):
+        '''
+        input:
+            agent_mask: tensor([B, N]) or ([N,]), i.e. info['alive_mask'] of each env in batch
+            env_ids: array([B,]), the env of each row, rows 0..B-1 by default
+        output:
+            senters: a tensor like agent_mask, but set failed agents silent
+            sent: bool tensor like agent_mask, True for agents that sent messages successfully
+            failed: bool tensor like agent_mask, True for alive agents that failed to send messages
+        '''
+        alive = agent_mask.view(-1, agent_mask.shape[-1]) != 0
+        self.env_ids = np.arange(alive.shape[0]) if env_ids is None else np.asarray(env_ids).reshape(-1)
+        sent = self.step(alive).view(agent_mask.shape)
+        failed = (agent_mask != 0) & ~sent
+        return agent_mask.masked_fill(failed, 0), sent, failed
+
+    def step(self, alive):
+        '''
+        input:
+            alive: bool tensor([B, N]), agents contending for the channel in each phase
+        output:
+            sent: bool tensor([B, N]), agents that sent messages successfully
+        '''
+        phase = torch.full((alive.shape[0], 1), self.comm_pahse, dtype=torch.long, device=alive.device)
+        windows = torch.full(alive.shape, self.init_window, dtype=torch.long, device=alive.device)
+        waits = self._backoff(windows)
+        pending = alive.clone()
+        sent = torch.zeros_like(alive)
+        stages = torch.zeros(alive.shape, dtype=torch.long, device=alive.device)
+        rounds = attempts = collisions = 0
+        # same rounds as BatchChannel.step. Each round takes at least frame_slots, so there is a fixed
+        # number of them, rows that ended stay as they are. On an accelerator that avoids a host sync
+        # per round, on the cpu testing for the end is cheap and the rounds left are not
+        on_cpu = alive.device.type == 'cpu'
+        for _ in range(self.max_stages() - 1):
+            waits = waits.masked_fill(~pending, self.comm_pahse)
+            min_wait = waits.min(dim=1, keepdim=True)[0]
+            active = phase >= min_wait + self.frame_slots
+            if on_cpu and not active.any():
+                break
+            phase = torch.where(active, phase - min_wait - self.frame_slots, phase)
+            at_min = (waits == min_wait) & active
+            num_at_min = at_min.sum(dim=1, keepdim=True)
+            rounds += active.sum()
+            attempts += num_at_min.sum()
+            collisions += (num_at_min > 1).sum()
+
+            # the rest of contending agents count down
+            waits = torch.where(active, waits - min_wait, waits)
+
+            # no collision. the message can be sent successfully
+            success = at_min & (num_at_min == 1)
+            sent |= success
+            pending &= ~success
+
+            # collision happens, BEB and regenerate random wait time
+            collided = at_min & (num_at_min > 1)
+            if not on_cpu or collided.any():
+                stages += collided.long()
+                windows = torch.where(collided, (2 * (windows + 1) - 1).clamp(max=self.max_window), windows)
+                waits = torch.where(collided, self._backoff(windows), waits)
+        # counters stay tensors on the device
+        backoff = torch.zeros(self.max_stages(), dtype=torch.long, device=alive.device)
+        backoff.scatter_add_(0, stages.view(-1), alive.view(-1).long())
+        self.record(channel_phases=alive.shape[0], channel_contenders=alive.sum(),
+                    channel_attempts=attempts, channel_successes=sent.sum(),
+                    channel_collisions=collisions,
+                    channel_idle_slots=alive.shape[0] * self.comm_pahse - rounds * self.frame_slots,
+                    channel_backoff=backoff)
+        return sent
+
+    def _backoff(self, windows):
+        # uniform random wait time in [0, window]
+        u = torch.rand(windows.shape, generator=self.get_generator(windows.device), device=windows.device)
+        return (u * (windows + 1).to(u.dtype)).long()
+
+
+CHANNELS = {
+    'csma_loop': Channel,
+    'csma': BatchChannel,
+    'csma_table': TableChannel,
+    'csma_torch': TorchChannel,
+    'ideal': IdealChannel,
+    'bernoulli': BernoulliChannel,
+    'aloha': AlohaChannel,
+    'tdma': TDMAChannel,
+}
+
+
+def make_channel(args):
+    '''
+    input:
+        args: Namespace with channel name and channel parameters, see main.py
+    output:
+        channel: MAC model instance from CHANNELS
+    '''
+    name = args.channel if hasattr(args, 'channel') else 'csma_loop'
+    if name not in CHANNELS:
+        raise RuntimeError("wrong channel name, available channels: [{}]".format('|'.join(CHANNELS)))
+    channel_class = CHANNELS[name]
+
+    # cli name --> constructor argument
+    params = {'comm_phase': 'comm_pahse', 'frame_slots': 'frame_slots',
+              'init_window': 'init_window', 'max_window': 'max_window'}
+    params.update({key: key for key in channel_class.extra_args})
+    kwargs = {param: getattr(args, key) for key, param in params.items() if hasattr(args, key)}
+    return channel_class(**kwargs)
@@ -1,4 +1,5 @@
 from ast import arg
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -6,7 +7,8 @@ from torch import nn
 from models import MLP
 from action_utils import select_action, translate_action
 
-from channel import Channel
+from channel import make_channel
+from utils import PhaseTimer
 
 class CommNetMLP(nn.Module):
     """
@@ -46,6 +48,11 @@ class CommNetMLP(nn.Module):
             self.comm_mask = torch.ones(self.nagents, self.nagents) \
                             - torch.eye(self.nagents, self.nagents)
 
+        # Sparse communication, only with the nearest agents by location in env info
+        self.comm_neighbors = args.comm_neighbors if hasattr(args, 'comm_neighbors') else 0
+        self.comm_radius = args.comm_radius if hasattr(args, 'comm_radius') else -1
+        self.self_mask = torch.eye(self.nagents, self.nagents).bool()
+
 
         # Since linear layers in PyTorch now accept * as any number of dimensions
         # between last and first dim, num_agents dimension will be covered.
@@ -91,28 +98,95 @@ class CommNetMLP(nn.Module):
         self.value_head = nn.Linear(self.hid_size, 1)
 
         # 信道
-        self.channel = Channel()
+        self.channel = make_channel(args)
+        self.timer = PhaseTimer()
         
     def get_agent_mask(self, batch_size, info):
+        '''
+        input:
+            batch_size: number of envs B in the forward
+            info: info['alive_mask'] is array[N] for a single env, or array[B,N] with one row per env,
+                  info['channel_senters'] replays a channel outcome recorded from self.senters,
+                  info['env_id'] is array[B], the env of each row, for channels keeping state per env
+        output:
+            num_agents_alive: tensor[B], agents that sent successfully in each env
+            agent_mask: tensor[B,N], alive agents
+            dead_senter: tensor[B,N], alive agents that sent successfully
+        '''
         n = self.nagents    # 10
         if 'alive_mask' in info:
-            agent_mask = torch.from_numpy(info['alive_mask'])   # numpy --> tensor
-            dead_senter, who_sent, who_failed = self.channel.send(info['alive_mask'])
-            dead_senter = torch.from_numpy(dead_senter)
-            num_agents_alive = dead_senter.sum()
+            alive_mask = info['alive_mask'].reshape(-1, n)  # [1,10] or [B,10], one contention phase per env
+            agent_mask = torch.from_numpy(alive_mask)   # numpy --> tensor, shares memory
+            with self.timer('channel'):
+                if 'channel_senters' in info:
+                    dead_senter = torch.as_tensor(info['channel_senters']).view(-1, n)
+                elif self.channel.native_torch:
+                    dead_senter, who_sent, who_failed = self.channel.send(agent_mask, info.get('env_id'))
+                elif self.channel.batched:
+                    dead_senter, who_sent, who_failed = self.channel.send(alive_mask, info.get('env_id'))
+                    dead_senter = torch.from_numpy(dead_senter)
+                else:   # loop engine, one env at a time
+                    dead_senter = torch.from_numpy(np.stack([self.channel.send(m)[0] for m in alive_mask]))
         else:
-            agent_mask = torch.ones(n)
-            num_agents_alive = n
-            dead_senter = torch.ones(n)
+            agent_mask = torch.ones(1, n)
+            dead_senter = torch.ones(1, n)
 
-        agent_mask = agent_mask.view(1, 1, n)   # [1,1,10]
-        agent_mask = agent_mask.expand(batch_size, n, n).unsqueeze(-1)  # [1,10,10,1]
+        agent_mask = agent_mask.expand(batch_size, n)   # [1,10]
+        dead_senter = dead_senter.expand(batch_size, n)   # [1,10]
+        num_agents_alive = dead_senter.sum(1)   # [1]
+        self.senters = dead_senter  # channel outcome of the last forward
 
-        dead_senter = dead_senter.view(1, 1, n)   # [1,1,10]
-        dead_senter = dead_senter.expand(batch_size, n, n).unsqueeze(-1)  # [1,10,10,1]
-        
         return num_agents_alive, agent_mask, dead_senter
 
+    def get_agent_locs(self, info):
+        '''
+        output:
+            locs: array[N,2] or [B,N,2], locations of the agents in env info, None if there are none
+        '''
+        if 'agent_locs' in info:    # already extracted
+            return info['agent_locs']
+        elif 'car_loc' in info:   # traffic junction
+            return info['car_loc']
+        elif 'predator_locs' in info:   # predator prey, preys are agents with enemy_comm
+            locs = info['predator_locs']
+            if 'prey_locs' in info:
+                locs = np.concatenate([locs, info['prey_locs']], axis=-2)[..., :self.nagents, :]
+            return locs
+        return None
+
+    def get_neighbors(self, batch_size, info, agent_mask):
+        '''
+        input:
+            agent_mask: tensor[B,N], agents that send, i.e. alive and talking
+        output:
+            None for all-to-all communication, or when info has no agent locations yet
+            nb_idx: tensor[B,N,k], indexes of the k nearest other agents of each agent
+            nb_mask: tensor[B,N,k], 1 for neighbours within comm_radius
+        '''
+        n = self.nagents
+        if self.comm_neighbors <= 0 and self.comm_radius < 0:
+            return None
+
+        locs = self.get_agent_locs(info)
+        if locs is None:
+            return None
+
+        locs = torch.as_tensor(np.asarray(locs)).to(self.comm_mask.dtype)
+        locs = locs.view(-1, n, 2).expand(batch_size, n, 2)
+        # pairwise distances are N^2 scalars, the N^2 * hid_size part is what sparse comm avoids
+        dist = (locs.unsqueeze(2) - locs.unsqueeze(1)).norm(dim=-1)    # [1,10,10]
+        dist = dist.masked_fill(self.self_mask, float('inf'))
+        # non-senders never take a neighbour slot, e.g. dead cars parked at (0, 0) in TJ
+        dist = dist.masked_fill(agent_mask.unsqueeze(1) == 0, float('inf'))
+
+        k = n - 1 if self.comm_neighbors <= 0 else min(self.comm_neighbors, n - 1)
+        nb_dist, nb_idx = dist.topk(k, dim=2, largest=False)    # [1,10,k]
+        if self.comm_radius >= 0:
+            nb_mask = (nb_dist <= self.comm_radius).to(dist.dtype)
+        else:
+            nb_mask = torch.ones_like(nb_dist)
+        return nb_idx, nb_mask
+
     def forward_state_encoder(self, x):
         hidden_state, cell_state = None, None
 
@@ -141,9 +215,10 @@ class CommNetMLP(nn.Module):
             x {list}
                 0: obs of agents tensor[B x N x num_inputs]
                 1: tuple
-                    0: hidden_state tensor[ N x hid_size]
-                    1: cell_state tensor[N x hid_size]     
-            B: Batch Size: Normally 1 in case of episode
+                    0: hidden_state tensor[(B * N) x hid_size]
+                    1: cell_state tensor[(B * N) x hid_size]
+            info {dict} -- env info, per env arrays have a leading B dimension when B > 1
+            B: Batch Size: Normally 1 in case of episode, number of envs when stepping envs together
             N: number of agents
             num_inputs : 61 for tf_medium
             
@@ -170,12 +245,28 @@ class CommNetMLP(nn.Module):
 
         # Hard Attention - action whether an agent communicates or not
         if self.args.hard_attn: # false
-            comm_action = torch.tensor(info['comm_action'])
-            comm_action_mask = comm_action.expand(batch_size, n, n).unsqueeze(-1)
+            comm_action = torch.tensor(info['comm_action']).view(-1, n)   # [1,10] or [B,10]
+            comm_action_mask = comm_action.expand(batch_size, n)
             # action 1 is talk, 0 is silent i.e. act as dead for comm purposes.
-            agent_mask *= comm_action_mask.double()
-
-        agent_mask_transpose = agent_mask.transpose(1, 2)   # tensor[1,10,10,1]
+            agent_mask = agent_mask * comm_action_mask.to(agent_mask.dtype)
+
+        # Combined mask[b, j, i] for communication from agent i to agent j, tensor[1,10,10]:
+        # no <self communication>, no communication <from dead agents> (and silent ones),
+        # and dead_senters, i.e. agents that failed on the channel, mask the receiving side j
+        comm_mask = dead_senters.unsqueeze(2) * self.comm_mask.t().unsqueeze(0) * agent_mask.unsqueeze(1)
+
+        if hasattr(self.args, 'comm_mode') and self.args.comm_mode == 'avg':
+            # the same normalizer with or without neighbours, so k = N - 1 is the dense comm.
+            # no averaging in envs with a single alive agent
+            comm_mask = comm_mask / (num_agents_alive - 1).clamp(min=1).view(batch_size, 1, 1).to(comm_mask.dtype)
+
+        neighbors = self.get_neighbors(batch_size, info, agent_mask)
+        if neighbors is not None:
+            # keep the mask only for the neighbours of each agent, tensor[1,10,k]
+            nb_idx, nb_mask = neighbors
+            comm_mask = comm_mask.gather(2, nb_idx) * nb_mask
+            # rows of the neighbours in [B*N, hid_size]
+            nb_rows = (nb_idx + torch.arange(batch_size).view(-1, 1, 1) * n).view(-1)
 
         for i in range(self.comm_passes):
             
@@ -183,29 +274,13 @@ class CommNetMLP(nn.Module):
             # Choose current or prev depending on recurrent
             comm = hidden_state.view(batch_size, n, self.hid_size) if self.args.recurrent else hidden_state # [10,128] --> [1,10,128]
 
-            # Get the next communication vector based on next hidden state
-            comm = comm.unsqueeze(-2).expand(-1, n, n, self.hid_size)   # [1,10,128] --> [1,10,1,128] --> [1,10,10,128]
-
-            # Create mask for masking <self communication>
-            mask = self.comm_mask.view(1, n, n) # tensor[1,10,10]
-            mask = mask.expand(comm.shape[0], n, n) # [1, 10, 10]
-            mask = mask.unsqueeze(-1)   # [1,10,10,1]
-
-            mask = mask.expand_as(comm) # [1,10,10,128]
-            comm = comm * mask  # [1,10,10,128]
-            
-            if hasattr(self.args, 'comm_mode') and self.args.comm_mode == 'avg' \
-                and num_agents_alive > 1:
-                comm = comm / (num_agents_alive - 1)
-
-            # Mask comm_in
-            # Mask communcation <from dead agents>
-            comm = comm * dead_senters
-            # Mask communication <to dead agents>
-            comm = comm * agent_mask_transpose
-
             # Combine all of C_j for an ith agent which essentially are h_j
-            comm_sum = comm.sum(dim=1)  # [1,10,10,128] --> [1,10,128]
+            if neighbors is not None:
+                comm = comm.reshape(batch_size * n, self.hid_size)[nb_rows]
+                comm = comm.view(batch_size, n, -1, self.hid_size)  # [1,10,k,128]
+                comm_sum = torch.matmul(comm_mask.unsqueeze(2), comm).squeeze(2)  # [1,10,1,k] x [1,10,k,128] --> [1,10,128]
+            else:
+                comm_sum = torch.bmm(comm_mask, comm)  # [1,10,10] x [1,10,128] --> [1,10,128]
             c = self.C_modules[i](comm_sum)
             ##########
 
@@ -34,3 +34,16 @@ def init(env_name, args, final_init=True):
         raise RuntimeError("wrong env name")
 
     return env
+
+def init_vector(env_name, args, nenvs, final_init=True, asynchronous=False, batched=False):
+    if batched:
+        # all envs simulated in the arrays of one env
+        if env_name != 'traffic_junction':
+            raise RuntimeError("batched envs are only implemented for traffic_junction")
+        env = gym.make('TrafficJunctionBatch-v0')
+        env.multi_agent_init(args, nenvs)
+        return BatchVectorEnv(env, args.max_steps)
+    if asynchronous:
+        # envs are made in the worker processes
+        return SubprocVectorEnv([lambda: init(env_name, args, final_init)] * nenvs, args.max_steps, args.nagents)
+    return VectorEnv([init(env_name, args, final_init) for _ in range(nenvs)], args.max_steps)
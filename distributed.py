@@ -0,0 +1,67 @@
+import torch
+import torch.distributed as dist
+from utils import *
+
+class DistributedTrainer(object):
+    '''
+    Data parallel training over torch.distributed, one trainer per rank, ranks can be on different nodes.
+    Every rank runs its own batch, the flat grads are summed with one all_reduce and every rank
+    applies the same update, so policy_net stays the same everywhere without sending params.
+    Launch one process per rank, e.g. with torchrun, which sets RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT.
+    '''
+    def __init__(self, args, trainer_maker):
+        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
+                                world_size=args.world_size, rank=args.rank)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.is_master = self.rank == 0
+
+        self.trainer = trainer_maker()
+        # start from the params of rank 0, then let each rank run its own episodes
+        for p in self.trainer.params:
+            dist.broadcast(p.data, 0)
+        torch.manual_seed(args.seed + self.rank)
+        np.random.seed(args.seed + self.rank)
+
+        # flat grads of all params, and num_steps in the last slot so it is summed in the same all_reduce
+        nparams = sum(p.numel() for p in self.trainer.params)
+        self.grads = torch.zeros(nparams + 1, dtype=self.trainer.params[0].dtype)
+
+    def quit(self):
+        self.trainer.quit()
+        dist.destroy_process_group()
+
+    def train_batch(self, epoch):
+        '''
+        output:
+            stat: stat of the batches of all ranks, the same on every rank
+        '''
+        batch, stat = self.trainer.run_batch(epoch)
+        self.trainer.optimizer.zero_grad()
+        s = self.trainer.compute_grad(batch)
+        merge_stat(s, stat)
+
+        timer = self.trainer.timer
+        with timer('reduce'):
+            copy_flat_grad_to(self.trainer.params, self.grads[:-1])
+            self.grads[-1] = stat['num_steps']
+            dist.all_reduce(self.grads, op=dist.ReduceOp.SUM)
+            self.grads[:-1] /= self.grads[-1]
+            set_flat_grad_to(self.trainer.params, self.grads[:-1])
+        with timer('optimizer'):
+            self.trainer.optimizer.step()
+        merge_stat(timer.get_stat(), stat)
+
+        # stats are dicts of numbers and arrays, all_gather_object pickles them into byte tensors
+        stats = [None] * self.world_size
+        dist.all_gather_object(stats, stat)
+        stat = dict()
+        for s in stats:
+            merge_stat(s, stat)
+        return stat
+
+    def state_dict(self):
+        return self.trainer.state_dict()
+
+    def load_state_dict(self, state):
+        self.trainer.load_state_dict(state)
@@ -1,8 +1,10 @@
 import time
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from gym import spaces
 from inspect import getargspec
+from utils import PhaseTimer
 
 class GymWrapper(object):
     '''
@@ -10,6 +12,7 @@ class GymWrapper(object):
     '''
     def __init__(self, env):
         self.env = env
+        self.timer = PhaseTimer()
 
     @property
     def observation_dim(self):
@@ -63,7 +66,8 @@ class GymWrapper(object):
         else:
             obs = self.env.reset()
 
-        obs = self._flatten_obs(obs)
+        with self.timer('obs'):
+            obs = self._flatten_obs(obs)
         return obs
 
     def display(self):
@@ -80,7 +84,8 @@ class GymWrapper(object):
             action = action[0]
         obs, r, done, info = self.env.step(action)
         
-        obs = self._flatten_obs(obs)
+        with self.timer('obs'):
+            obs = self._flatten_obs(obs)
         return (obs, r, done, info)
 
     def reward_terminal(self):
@@ -110,3 +115,297 @@ class GymWrapper(object):
             return self.env.stat
         else:
             return dict()
+
+
+def step_env(env, action, truncate, epoch):
+    '''
+    Step a GymWrapper env, and reset it when the episode ends (by the env, or truncated at max_steps).
+    The info of the last step also has 'reward_terminal' and 'stat' of the finished episode,
+    'truncated' and the 'terminal_obs' replaced by the first obs of the next episode.
+    '''
+    obs, r, done, info = env.step(action)
+    if done or truncate:
+        info['truncated'] = not done
+        info['terminal_obs'] = obs
+        info['reward_terminal'] = env.reward_terminal()
+        info['stat'] = env.get_stat()
+        obs = env.reset(epoch)
+        done = True
+    return obs, r, done, info
+
+
+class VectorEnv(object):
+    '''
+    K copies of a GymWrapper env stepped in lockstep, with per-env auto-reset
+    '''
+    is_async = False    # envs step in the caller, step_wait() does all the work
+
+    def __init__(self, envs, max_steps):
+        self.envs = envs
+        self.timer = PhaseTimer()   # obs times of all the envs
+        for env in envs:
+            env.timer = self.timer
+        self.num_envs = len(envs)
+        self.max_steps = max_steps  # episodes are cut at max_steps, like Trainer.get_episode does
+        self.steps = np.zeros(self.num_envs, dtype=int)    # steps taken in the running episode of each env
+        self.epoch = None
+        self.pending = dict()   # env index -> action given to step_async
+
+    @property
+    def observation_dim(self):
+        return self.envs[0].observation_dim
+
+    @property
+    def num_actions(self):
+        return self.envs[0].num_actions
+
+    @property
+    def dim_actions(self):
+        return self.envs[0].dim_actions
+
+    @property
+    def action_space(self):
+        return self.envs[0].action_space
+
+    def reset(self, epoch):
+        '''
+        output:
+            obs: tensor[K, N, obs_dim]
+        '''
+        self.epoch = epoch  # for auto-resets
+        self.steps[:] = 0
+        return torch.cat([env.reset(epoch) for env in self.envs])
+
+    def step(self, actions, idx=None):
+        '''
+        input:
+            actions: list of actions, one per env in idx, each as taken by GymWrapper.step
+            idx: indexes of the envs to step, all envs by default
+        output:
+            obs: tensor[len(idx), N, obs_dim], first obs of the next episode for envs that got done
+            reward: array[len(idx), N]
+            done: bool array[len(idx)], episode ended by the env or by max_steps
+            infos: list of info dicts, for envs that got done it also has
+                'reward_terminal', 'stat' and 'num_steps' of the finished episode
+        '''
+        idx = range(self.num_envs) if idx is None else idx
+        self.step_async(actions, idx)
+        return self.step_wait(idx)
+
+    def step_async(self, actions, idx=None):
+        idx = range(self.num_envs) if idx is None else idx
+        for k, action in zip(idx, actions):
+            self.pending[k] = action
+
+    def step_wait(self, idx=None):
+        '''
+        output: same as step(), for the envs in idx given to step_async
+        '''
+        idx = range(self.num_envs) if idx is None else idx
+        results = [self._step_wait(k) for k in idx]
+        obs, rewards, dones, infos = zip(*results)
+        for k, done, info in zip(idx, dones, infos):
+            self.steps[k] += 1
+            if done:
+                info['num_steps'] = int(self.steps[k])
+                self.steps[k] = 0
+        return torch.cat(obs), np.stack(rewards), np.array(dones), list(infos)
+
+    def _step_wait(self, k):
+        truncate = self.steps[k] + 1 == self.max_steps
+        return step_env(self.envs[k], self.pending.pop(k), truncate, self.epoch)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def stack_info(infos, nagents):
+        '''
+        Stack the array entries of per env infos into [K, ...] arrays, for one batched forward.
+        Envs at the start of an episode have empty info, i.e. all agents alive.
+        Other keys missing in some of the envs are dropped.
+        '''
+        info = dict()
+        for key in infos[0]:
+            if all(isinstance(i.get(key), np.ndarray) for i in infos):
+                info[key] = np.stack([i[key] for i in infos])
+        if 'alive_mask' not in info and any('alive_mask' in i for i in infos):
+            info['alive_mask'] = np.stack([i.get('alive_mask', np.ones(nagents)) for i in infos])
+        return info
+
+
+class VectorEnvWorker(mp.Process):
+    '''
+    Holds one env of a SubprocVectorEnv, writes its observations into the shared buffer
+    '''
+    def __init__(self, id, env_maker, comm, parent_comm, seed):
+        super(VectorEnvWorker, self).__init__()
+        self.id = id
+        self.env_maker = env_maker
+        self.comm = comm
+        self.parent_comm = parent_comm
+        self.seed = seed
+        self.daemon = True
+
+    def run(self):
+        # the copy of the parent's end forked with this process, so recv sees EOF once the parent is gone
+        self.parent_comm.close()
+        torch.manual_seed(self.seed + self.id)
+        np.random.seed(self.seed + self.id)
+        env = self.env_maker()
+        obs_buf = None
+        epoch = None
+
+        while True:
+            try:
+                task, data = self.comm.recv()
+            except EOFError:
+                return
+            if task == 'quit':
+                return
+            elif task == 'spaces':
+                self.comm.send((env.observation_dim, env.num_actions, env.dim_actions, env.action_space))
+            elif task == 'buffer':
+                obs_buf = data[self.id]   # [N, obs_dim] in shared memory
+            elif task == 'reset':
+                epoch = data
+                obs_buf.copy_(env.reset(epoch).view_as(obs_buf))
+                self.comm.send(None)
+            elif task == 'step':
+                action, truncate = data
+                obs, r, done, info = step_env(env, action, truncate, epoch)
+                obs_buf.copy_(obs.view_as(obs_buf))
+                self.comm.send((r, done, info))
+
+
+class SubprocVectorEnv(VectorEnv):
+    '''
+    VectorEnv with each env in its own worker process.
+    Observations come back through a shared memory buffer, the rest over pipes.
+    step_async() returns right away, so env steps run in parallel with each other
+    and with whatever the caller does before step_wait().
+    '''
+    is_async = True
+    # plain attributes here, set from the first worker
+    observation_dim = num_actions = dim_actions = action_space = None
+
+    def __init__(self, env_makers, max_steps, nagents):
+        self.num_envs = len(env_makers)
+        self.max_steps = max_steps
+        self.steps = np.zeros(self.num_envs, dtype=int)
+        self.comms = []
+        self.workers = []
+        seed = np.random.randint(10000)   # differs for every SubprocVectorEnv made in this process
+        for i, env_maker in enumerate(env_makers):
+            comm, comm_remote = mp.Pipe()
+            self.comms.append(comm)
+            worker = VectorEnvWorker(i, env_maker, comm_remote, comm, seed)
+            worker.start()
+            comm_remote.close()
+            self.workers.append(worker)
+
+        self.comms[0].send(('spaces', None))
+        self.observation_dim, self.num_actions, self.dim_actions, self.action_space = self.comms[0].recv()
+        self.obs_buf = torch.zeros(self.num_envs, nagents, self.observation_dim).double().share_memory_()
+        for comm in self.comms:
+            comm.send(('buffer', self.obs_buf))
+
+    def reset(self, epoch):
+        self.steps[:] = 0
+        for comm in self.comms:
+            comm.send(('reset', epoch))
+        for comm in self.comms:
+            comm.recv()
+        return self.obs_buf.clone()
+
+    def step_async(self, actions, idx=None):
+        idx = range(self.num_envs) if idx is None else idx
+        for k, action in zip(idx, actions):
+            self.comms[k].send(('step', (action, self.steps[k] + 1 == self.max_steps)))
+
+    def _step_wait(self, k):
+        r, done, info = self.comms[k].recv()
+        return self.obs_buf[k:k+1].clone(), r, done, info
+
+    def close(self):
+        '''
+        Stop the workers, only from the process that made this env
+        '''
+        for comm in self.comms:
+            comm.send(('quit', None))
+            comm.close()
+        for worker in self.workers:
+            worker.join()
+        self.comms = []
+        self.workers = []
+
+
+class BatchVectorEnv(VectorEnv):
+    '''
+    VectorEnv over one batched env that simulates its K instances in the same arrays,
+    e.g. TrafficJunctionBatchEnv: one env call steps all of them.
+    The batched env takes a [len(idx), N] action array and the instance indexes,
+    and returns obs [len(idx), N, obs_dim], rewards, dones and a dict of stacked infos.
+    '''
+    is_async = False
+
+    def __init__(self, env, max_steps):
+        self.env = env
+        self.wrapper = GymWrapper(env)  # for the spaces
+        self.timer = PhaseTimer()
+        self.num_envs = env.nenvs
+        self.max_steps = max_steps
+        self.steps = np.zeros(self.num_envs, dtype=int)
+        self.epoch = None
+        self.pending = dict()
+
+    @property
+    def observation_dim(self):
+        return self.wrapper.observation_dim
+
+    @property
+    def num_actions(self):
+        return self.wrapper.num_actions
+
+    @property
+    def dim_actions(self):
+        return self.wrapper.dim_actions
+
+    @property
+    def action_space(self):
+        return self.wrapper.action_space
+
+    def reset(self, epoch):
+        self.epoch = epoch
+        self.steps[:] = 0
+        obs = self.env.reset(epoch)
+        with self.timer('obs'):
+            obs = torch.from_numpy(obs).double()
+        return obs
+
+    def step_wait(self, idx=None):
+        idx = np.arange(self.num_envs) if idx is None else np.asarray(idx)
+        actions = [self.pending.pop(k) for k in idx]
+        if self.dim_actions == 1:
+            actions = [action[0] for action in actions]
+        obs, rewards, dones, info = self.env.step(np.stack(actions), idx)
+        infos = [{key: value[b] for key, value in info.items()} for b in range(len(idx))]
+
+        # episodes ended by the env or cut at max_steps, reset all of them with one call
+        self.steps[idx] += 1
+        truncated = self.steps[idx] == self.max_steps
+        ended = np.nonzero(dones | truncated)[0]
+        for b in ended:
+            k = idx[b]
+            infos[b]['truncated'] = not dones[b]
+            infos[b]['terminal_obs'] = torch.from_numpy(obs[b:b+1].copy()).double()
+            infos[b]['reward_terminal'] = self.env.reward_terminal()
+            infos[b]['stat'] = self.env.get_stat(k)
+            infos[b]['num_steps'] = int(self.steps[k])
+        if len(ended) > 0:
+            obs[ended] = self.env.reset(self.epoch, idx[ended])
+            self.steps[idx[ended]] = 0
+
+        with self.timer('obs'):
+            obs = torch.from_numpy(obs).double()
+        return obs, rewards, dones | truncated, infos
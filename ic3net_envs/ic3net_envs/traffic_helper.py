@@ -1,5 +1,13 @@
+import os
+import pickle
 import numpy as np
 
+# on-disk cache of grids and routes, override with IC3NET_CACHE
+CACHE_DIR = os.environ.get('IC3NET_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ic3net'))
+# bump when the grids or routes built for a key change, so old cache files are not used
+LAYOUT_VERSION = 1
+_layouts = dict()
+
 move = [(-1,0),(1,0),(0,-1),(0,1)]
 
 def get_road_blocks(w, h, difficulty):
@@ -204,3 +212,46 @@ def get_routes(dims, grid, difficulty):
                     break
         routes.append(paths)
     return routes
+
+def freeze(value):
+    '''
+    input:
+        - value: array, or list / tuple / dict of them, nested
+    output:
+        - value, with every array in it made read-only
+    '''
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            freeze(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    return value
+
+def load_layout(key, build):
+    '''
+    returns
+        - layout: the dict build() returns for key = (difficulty, dims, vision, vocab_type),
+        built once per machine and then loaded from the cache.
+        Its arrays are shared by every env with the same key, so they are read-only.
+    '''
+    if key in _layouts:
+        return _layouts[key]
+
+    difficulty, dims, vision, vocab_type = key
+    name = 'traffic_junction_v{}_{}_{}x{}_{}_{}.pkl'.format(LAYOUT_VERSION, difficulty, dims[0], dims[1], vision, vocab_type)
+    path = os.path.join(CACHE_DIR, name)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            layout = pickle.load(f)
+    else:
+        layout = build()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(layout, f)
+        os.replace(tmp_path, path)  # atomic, several processes may build the same layout
+    _layouts[key] = freeze(layout)
+    return layout
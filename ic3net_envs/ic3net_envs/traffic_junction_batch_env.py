@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Simulate K independent traffic junction instances in one set of arrays.
+
+Design Decisions:
+    - Same rules, routes and obs as TrafficJunctionEnv, whose grid, route table and
+      obs index tables are shared by all instances
+    - Car state has a leading instance axis, [K, ncar, ...]
+    - Each instance has its own episode: reset, curriculum add_rate and stat
+    - step and reset take the indexes of the instances to run, the others stay as they are
+"""
+
+# 3rd party modules
+import numpy as np
+from ic3net_envs.traffic_junction_env import TrafficJunctionEnv
+
+
+class TrafficJunctionBatchEnv(TrafficJunctionEnv):
+
+    def multi_agent_init(self, args, nenvs):
+        super(TrafficJunctionBatchEnv, self).multi_agent_init(args)
+        self.nenvs = nenvs
+
+        K, n = nenvs, self.ncar
+        self.alive_mask = np.zeros((K, n))
+        self.wait = np.zeros((K, n))
+        self.cars_in_sys = np.zeros(K, dtype=int)
+        self.route_id = np.full((K, n), -1)
+        self.car_loc = np.zeros((K, n, len(self.dims)), dtype=int)
+        self.car_last_act = np.zeros((K, n), dtype=int)
+        self.car_route_loc = np.full((K, n), -1)
+        self.is_completed = np.zeros((K, n))
+        self.has_failed = np.zeros(K, dtype=int)
+
+        self.add_rate = np.full(K, self.add_rate_min)
+        self.epoch_last_update = np.zeros(K)
+
+        # number of cars in each cell of pad_grid of each instance, only nonzero while _get_obs runs
+        self.car_count = np.zeros((K,) + self.pad_grid.shape, dtype=int)
+
+    def reset(self, epoch=None, idx=None):
+        """
+        Reset the instances in idx, all by default.
+
+        Returns
+        -------
+        obs (len(idx) x ncar x obs_dim) : the initial observation of each instance.
+        """
+        idx = np.arange(self.nenvs) if idx is None else np.asarray(idx)
+
+        self.alive_mask[idx] = 0
+        self.wait[idx] = 0
+        self.cars_in_sys[idx] = 0
+        self.route_id[idx] = -1
+        self.car_loc[idx] = 0
+        self.car_last_act[idx] = 0
+        self.car_route_loc[idx] = -1
+        self.has_failed[idx] = 0
+
+        # set add rate of each instance according to the curriculum
+        epoch_range = (self.curr_end - self.curr_start)
+        add_rate_range = (self.add_rate_max - self.add_rate_min)
+        if epoch is not None and epoch_range > 0 and add_rate_range > 0 and self.curr_start <= epoch <= self.curr_end:
+            update = idx[epoch > self.epoch_last_update[idx]]
+            self.add_rate[update] = self._curriculum_rate(epoch)
+            self.epoch_last_update[update] = epoch
+
+        return self._get_obs(idx)
+
+    def step(self, action, idx=None):
+        """
+        The cars of the instances in idx take a step, all instances by default.
+
+        Parameters
+        ----------
+        action : shape - len(idx) x ncar
+
+        Returns
+        -------
+        obs, reward, episode_over, info : tuple
+            obs (len(idx) x ncar x obs_dim) :
+            reward (len(idx) x ncar) : PENALTY for each timestep when in sys & CRASH PENALTY on crashes.
+            episode_over (bool array of len(idx)) : the env never ends episodes, they are cut at max steps.
+            info (dict) : arrays with the instances as first axis.
+        """
+        idx = np.arange(self.nenvs) if idx is None else np.asarray(idx)
+        active = np.zeros(self.nenvs, dtype=bool)
+        active[idx] = True
+
+        action = np.array(action).reshape(len(idx), self.ncar)
+        assert np.all(action <= self.naction), "Actions should be in the range [0,naction)."
+        actions = np.zeros((self.nenvs, self.ncar), dtype=int)
+        actions[idx] = action
+
+        # No one is completed before taking action
+        self.is_completed[:] = 0
+
+        self._take_actions(actions, active)
+
+        self._add_cars(active)
+
+        obs = self._get_obs(idx)
+        reward = self._get_reward(idx)
+
+        debug = {'car_loc': self.car_loc[idx],
+                 'alive_mask': self.alive_mask[idx],
+                 'wait': self.wait[idx],
+                 'cars_in_sys': self.cars_in_sys[idx],
+                 'is_completed': self.is_completed[idx]}
+
+        return obs, reward, np.zeros(len(idx), dtype=bool), debug
+
+    def get_stat(self, k):
+        return {'success': 1 - self.has_failed[k], 'add_rate': self.add_rate[k]}
+
+    def render(self, mode='human', close=False):
+        raise NotImplementedError("TrafficJunctionBatchEnv has no display, use TrafficJunctionEnv")
+
+    def _get_obs(self, idx):
+        """
+        Returns
+        -------
+        obs (len(idx) x ncar x obs_dim) : flat obs of each car, 0 for dead cars
+        """
+        h, w = self.dims
+        m = len(idx)
+        car_loc = self.car_loc[idx].reshape(-1, len(self.dims))
+        obs = np.zeros((m * self.ncar, self.obs_dim))
+
+        # most recent action, route id and loc
+        obs[:, 0] = self.car_last_act[idx].reshape(-1) / (self.naction - 1)
+        obs[:, 1] = self.route_id[idx].reshape(-1) / (self.npath - 1)
+        if self.vocab_type == 'scalar':
+            obs[:, 2:4] = car_loc / (h - 1, w - 1)
+
+        # vision squares, one row of cells per car
+        ys = car_loc[:, 0:1] + self.square_dy
+        xs = car_loc[:, 1:2] + self.square_dx
+        cols = self.pad_cols[ys, xs]
+        car, cell = np.nonzero(cols >= 0)
+        obs[car, self.square_index[cell] + cols[car, cell]] = 1
+
+        # cars' location in their own instance, dead cars included, as in the grid
+        inst = np.repeat(np.arange(m), self.ncar)
+        loc = (inst, car_loc[:, 0] + self.vision, car_loc[:, 1] + self.vision)
+        np.add.at(self.car_count, loc, 1)
+        obs[:, self.square_car_index] += self.car_count[inst[:, None], ys, xs]
+        self.car_count[loc] = 0
+
+        # when dead, all obs are 0. But should be masked by trainer.
+        obs[self.alive_mask[idx].reshape(-1) == 0] = 0
+        return obs.reshape(m, self.ncar, self.obs_dim)
+
+    def _add_cars(self, active):
+        nroute = len(self.routes)
+        npath = len(self.routes[0])
+        # one draw per instance, as in TrafficJunctionEnv._add_cars
+        draw = np.random.uniform(size=(self.nenvs, 2 * nroute + self.ncar))
+
+        # arrival points adding a car, in order until all cars of the instance are in the system
+        spawn = (draw[:, :nroute] <= self.add_rate[:, None]) & active[:, None]
+        spawn &= np.cumsum(spawn, axis=1) <= (self.ncar - self.cars_in_sys)[:, None]
+        nspawn = spawn.sum(axis=1)
+        if not nspawn.any():
+            return
+        k, r_i = np.nonzero(spawn)
+
+        # chose dead cars on random & make them alive, the j-th one takes the j-th arrival point
+        order = np.argsort(np.where(self.alive_mask == 0, draw[:, 2 * nroute:], np.inf), axis=1)
+        car = order[np.arange(self.ncar) < nspawn[:, None]]
+        self.alive_mask[k, car] = 1
+
+        # choose paths randomly & set them
+        p_i = (draw[k, nroute + r_i] * npath).astype(int)
+        self.route_id[k, car] = p_i + r_i * npath
+
+        # set start loc
+        self.car_route_loc[k, car] = 0
+        self.car_loc[k, car] = self.route_table[self.route_id[k, car], 0]
+
+        # increase count
+        self.cars_in_sys += nspawn
+
+    def _take_actions(self, action, active):
+        # non-active cars, and cars of instances not stepped, do nothing
+        alive = (self.alive_mask != 0) & active[:, None]
+
+        # add wait time for active cars
+        self.wait[alive] += 1
+
+        # action BRAKE i.e STAY
+        self.car_last_act[alive & (action == 1)] = 1
+
+        # GAS or move
+        gas = alive & (action == 0)
+        self.car_route_loc[gas] += 1
+
+        # car/agent has reached end of its path
+        completed = gas & (self.car_route_loc == self.route_len[self.route_id])
+        self.cars_in_sys -= completed.sum(axis=1)
+        self.alive_mask[completed] = 0
+        self.wait[completed] = 0
+        # put it at dead loc
+        self.car_loc[completed] = 0
+        self.is_completed[completed] = 1
+
+        move = gas & ~completed
+        self.car_loc[move] = self.route_table[self.route_id[move], self.car_route_loc[move]]
+        # Change last act for color:
+        self.car_last_act[move] = 0
+
+    def _get_reward(self, idx):
+        m = len(idx)
+        reward = np.full((m, self.ncar), self.TIMESTEP_PENALTY) * self.wait[idx]
+
+        # cars of the same instance sharing a cell crash, except at (0, 0) where dead cars are put
+        car_loc = self.car_loc[idx]
+        cell = car_loc[:, :, 0] * self.dims[1] + car_loc[:, :, 1]
+        key = cell + self.dims[0] * self.dims[1] * np.arange(m)[:, None]
+        crashed = (np.bincount(key.reshape(-1))[key] > 1) & (cell != 0)
+        reward[crashed] += self.CRASH_PENALTY
+        self.has_failed[idx] |= crashed.any(axis=1)
+
+        reward = self.alive_mask[idx] * reward
+        return reward
+
+    def reward_terminal(self):
+        return np.zeros(self.ncar)
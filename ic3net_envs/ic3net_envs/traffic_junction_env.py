@@ -148,12 +148,7 @@ class TrafficJunctionEnv(gym.Env):
                                     spaces.MultiBinary( (2*vision + 1, 2*vision + 1, self.vocab_size))))
             # Actual observation will be of the shape 1 * ncar * ((x,y) , (2v+1) * (2v+1) * vocab_size)
 
-        self._set_grid()
-
-        if difficulty == 'easy':
-            self._set_paths_easy()
-        else:
-            self._set_paths(difficulty)
+        self._set_layout()
 
         return
 
@@ -172,10 +167,9 @@ class TrafficJunctionEnv(gym.Env):
         self.wait = np.zeros(self.ncar)
         self.cars_in_sys = 0
 
-        # Chosen path for each car:
-        self.chosen_path = [0] * self.ncar
+        # Chosen path for each car, a row of route_table
         # when dead => no route, must be masked by trainer.
-        self.route_id = [-1] * self.ncar
+        self.route_id = np.full(self.ncar, -1)
 
         # self.cars = np.zeros(self.ncar)
         # Current car to enter system
@@ -232,8 +226,7 @@ class TrafficJunctionEnv(gym.Env):
         # No one is completed before taking action
         self.is_completed = np.zeros(self.ncar)
 
-        for i, a in enumerate(action):
-            self._take_action(i, a)
+        self._take_actions(action)
 
         self._add_cars()
 
@@ -298,6 +291,28 @@ class TrafficJunctionEnv(gym.Env):
     def seed(self):
         return
 
+    def _set_layout(self):
+        # grid, routes and route table only depend on the key, and finding the routes is slow,
+        # so they are built once and cached in this process and on disk. The arrays are shared, read only.
+        key = (self.difficulty, tuple(self.dims), self.vision, self.vocab_type)
+        layout = load_layout(key, self._build_layout)
+        for name, value in layout.items():
+            setattr(self, name, value)
+
+        self._set_obs_index()
+
+    def _build_layout(self):
+        self._set_grid()
+
+        if self.difficulty == 'easy':
+            self._set_paths_easy()
+        else:
+            self._set_paths(self.difficulty)
+        self._set_route_table()
+
+        names = ['grid', 'route_grid', 'pad_grid', 'routes', 'route_len', 'route_table']
+        return {name: getattr(self, name) for name in names if hasattr(self, name)}
+
     def _set_grid(self):
         self.grid = np.full(self.dims[0] * self.dims[1], self.OUTSIDE_CLASS, dtype=int).reshape(self.dims)
         w, h = self.dims
@@ -317,80 +332,91 @@ class TrafficJunctionEnv(gym.Env):
         # Padding for vision
         self.pad_grid = np.pad(self.grid, self.vision, 'constant', constant_values = self.OUTSIDE_CLASS)
 
-        self.empty_bool_base_grid = self._onehot_initialization(self.pad_grid)
+    def _set_obs_index(self):
+        # An obs is (last act, route id, (loc for scalar vocab,) vision square) flattened,
+        # the vision square is (2 * vision + 1) x (2 * vision + 1) cells of one-hot vocab.
+        # Index tables to build the obs of all cars with fancy indexing.
+        sq = 2 * self.vision + 1
+        self.obs_head = 2 if self.vocab_type == 'bool' else 4
+        self.obs_vocab = self.vocab_size
+        if self.vocab_type == 'bool':
+            # vocab column of each cell of pad_grid
+            self.pad_cols = self.pad_grid
+            car_col = self.CAR_CLASS
+        else:
+            # the outside class is removed, -1 for no column
+            self.pad_cols = self.pad_grid - 1
+            car_col = self.CAR_CLASS - 1
+        self.obs_dim = self.obs_head + sq * sq * self.obs_vocab
 
-    def _get_obs(self):
-        h, w = self.dims
-        self.bool_base_grid = self.empty_bool_base_grid.copy()
+        # cells of the vision square from its top left corner, which is the car loc in pad_grid
+        self.square_dy, self.square_dx = [d.reshape(1, -1) for d in np.mgrid[0:sq, 0:sq]]
+        # obs index of the first vocab column of each cell, and of the car column
+        self.square_index = self.obs_head + self.obs_vocab * np.arange(sq * sq)
+        self.square_car_index = self.square_index + car_col
 
-        # Mark cars' location in Bool grid
-        for i, p in enumerate(self.car_loc):
-            self.bool_base_grid[p[0] + self.vision, p[1] + self.vision, self.CAR_CLASS] += 1
+        # number of cars in each cell of pad_grid, only nonzero while _get_obs runs
+        self.car_count = np.zeros(self.pad_grid.shape, dtype=int)
 
+    def _get_obs(self):
+        """
+        Returns
+        -------
+        obs (ncar x obs_dim) : flat obs of each car, 0 for dead cars
+        """
+        h, w = self.dims
+        obs = np.zeros((self.ncar, self.obs_dim))
 
-        # remove the outside class.
+        # most recent action, route id and loc
+        obs[:, 0] = self.car_last_act / (self.naction - 1)
+        obs[:, 1] = self.route_id / (self.npath - 1)
         if self.vocab_type == 'scalar':
-            self.bool_base_grid = self.bool_base_grid[:,:,1:]
-
-
-        obs = []
-        for i, p in enumerate(self.car_loc):
-            # most recent action
-            act = self.car_last_act[i] / (self.naction - 1)
-
-            # route id
-            r_i = self.route_id[i] / (self.npath - 1)
-
-            # loc
-            p_norm = p / (h-1, w-1)
-
-            # vision square
-            slice_y = slice(p[0], p[0] + (2 * self.vision) + 1)
-            slice_x = slice(p[1], p[1] + (2 * self.vision) + 1)
-            v_sq = self.bool_base_grid[slice_y, slice_x]
-
-            # when dead, all obs are 0. But should be masked by trainer.
-            if self.alive_mask[i] == 0:
-                act = np.zeros_like(act)
-                r_i = np.zeros_like(r_i)
-                p_norm = np.zeros_like(p_norm)
-                v_sq = np.zeros_like(v_sq)
-
-            if self.vocab_type == 'bool':
-                o = tuple((act, r_i, v_sq))
-            else:
-                o = tuple((act, r_i, p_norm, v_sq))
-            obs.append(o)
-
-        obs = tuple(obs)
-
+            obs[:, 2:4] = self.car_loc / (h - 1, w - 1)
+
+        # vision squares, one row of cells per car
+        ys = self.car_loc[:, 0:1] + self.square_dy
+        xs = self.car_loc[:, 1:2] + self.square_dx
+        cols = self.pad_cols[ys, xs]
+        car, cell = np.nonzero(cols >= 0)
+        obs[car, self.square_index[cell] + cols[car, cell]] = 1
+
+        # cars' location, dead cars included, as in the grid
+        loc = (self.car_loc[:, 0] + self.vision, self.car_loc[:, 1] + self.vision)
+        np.add.at(self.car_count, loc, 1)
+        obs[:, self.square_car_index] += self.car_count[ys, xs]
+        self.car_count[loc] = 0
+
+        # when dead, all obs are 0. But should be masked by trainer.
+        obs[self.alive_mask == 0] = 0
         return obs
 
     def _add_cars(self):
-        for r_i, routes in enumerate(self.routes):
-            if self.cars_in_sys >= self.ncar:
-                return
-
-            # Add car to system and set on path
-            if np.random.uniform() <= self.add_rate:
+        nroute = len(self.routes)
+        npath = len(self.routes[0])
+        # one draw for the whole step: add or not and path at each arrival point, order of dead cars
+        draw = np.random.uniform(size=2 * nroute + self.ncar)
+
+        # arrival points adding a car, in order until all cars are in the system
+        r_i = np.nonzero(draw[:nroute] <= self.add_rate)[0][:self.ncar - self.cars_in_sys]
+        if len(r_i) == 0:
+            return
 
-                # chose dead car on random
-                idx = self._choose_dead()
-                # make it alive
-                self.alive_mask[idx] = 1
+        # chose dead cars on random & make them alive
+        dead = np.nonzero(self.alive_mask == 0)[0]
+        idx = dead[np.argsort(draw[2 * nroute:][dead])[:len(r_i)]]
+        self.alive_mask[idx] = 1
 
-                # choose path randomly & set it
-                p_i = np.random.choice(len(routes))
-                # make sure all self.routes have equal len/ same no. of routes
-                self.route_id[idx] = p_i + r_i * len(routes)
-                self.chosen_path[idx] = routes[p_i]
+        # choose paths randomly & set them
+        # make sure all self.routes have equal len/ same no. of routes
+        p_i = (draw[nroute:2 * nroute][r_i] * npath).astype(int)
+        self.route_id[idx] = p_i + r_i * npath
 
-                # set its start loc
-                self.car_route_loc[idx] = 0
-                self.car_loc[idx] = routes[p_i][0]
+        # set start loc
+        self.car_route_loc[idx] = 0
+        self.car_loc[idx] = self.route_table[self.route_id[idx], 0]
 
-                # increase count
-                self.cars_in_sys += 1
+        # increase count
+        self.cars_in_sys += len(r_i)
 
     def _set_paths_easy(self):
         h, w = self.dims
@@ -521,6 +547,17 @@ class TrafficJunctionEnv(gym.Env):
         # Test all paths
         assert self._unittest_path(paths)
 
+    def _set_route_table(self):
+        # routes as one array [npath, max route len, 2], padded with the last loc of each route.
+        # Path p_i from arrival point r_i is route p_i + r_i * len(routes).
+        paths = [np.asarray(p) for routes in self.routes for p in routes]
+        assert all(len(routes) == len(self.routes[0]) for routes in self.routes)
+        self.route_len = np.array([len(p) for p in paths])
+        self.route_table = np.zeros((len(paths), self.route_len.max(), len(self.dims)), dtype=int)
+        for i, p in enumerate(paths):
+            self.route_table[i] = p[-1]
+            self.route_table[i, :len(p)] = p
+
     def _unittest_path(self,paths):
         for i, p in enumerate(paths[:-1]):
             next_dif = p - np.row_stack([p[1:], p[-1]])
@@ -534,57 +571,43 @@ class TrafficJunctionEnv(gym.Env):
                 return False
         return True
 
-    def _take_action(self, idx, act):
-        # non-active car
-        if self.alive_mask[idx] == 0:
-            return
+    def _take_actions(self, action):
+        # non-active cars do nothing
+        alive = self.alive_mask != 0
 
         # add wait time for active cars
-        self.wait[idx] += 1
+        self.wait[alive] += 1
 
         # action BRAKE i.e STAY
-        if act == 1:
-            self.car_last_act[idx] = 1
-            return
+        self.car_last_act[alive & (action == 1)] = 1
 
         # GAS or move
-        if act==0:
-            prev = self.car_route_loc[idx]
-            self.car_route_loc[idx] += 1
-            curr = self.car_route_loc[idx]
-
-            # car/agent has reached end of its path
-            if curr == len(self.chosen_path[idx]):
-                self.cars_in_sys -= 1
-                self.alive_mask[idx] = 0
-                self.wait[idx] = 0
-
-                # put it at dead loc
-                self.car_loc[idx] = np.zeros(len(self.dims),dtype=int)
-                self.is_completed[idx] = 1
-                return
-
-            elif curr > len(self.chosen_path[idx]):
-                print(curr)
-                raise RuntimeError("Out of boud car path")
-
-            prev = self.chosen_path[idx][prev]
-            curr = self.chosen_path[idx][curr]
-
-            # assert abs(curr[0] - prev[0]) + abs(curr[1] - prev[1]) == 1 or curr_path = 0
-            self.car_loc[idx] = curr
-
-            # Change last act for color:
-            self.car_last_act[idx] = 0
+        gas = alive & (action == 0)
+        self.car_route_loc[gas] += 1
+
+        # car/agent has reached end of its path
+        completed = gas & (self.car_route_loc == self.route_len[self.route_id])
+        self.cars_in_sys -= int(completed.sum())
+        self.alive_mask[completed] = 0
+        self.wait[completed] = 0
+        # put it at dead loc
+        self.car_loc[completed] = 0
+        self.is_completed[completed] = 1
+
+        move = gas & ~completed
+        self.car_loc[move] = self.route_table[self.route_id[move], self.car_route_loc[move]]
+        # Change last act for color:
+        self.car_last_act[move] = 0
 
     def _get_reward(self):
         reward = np.full(self.ncar, self.TIMESTEP_PENALTY) * self.wait
 
-        for i, l in enumerate(self.car_loc):
-            if (len(np.where(np.all(self.car_loc[:i] == l,axis=1))[0]) or \
-               len(np.where(np.all(self.car_loc[i+1:] == l,axis=1))[0])) and l.any():
-               reward[i] += self.CRASH_PENALTY
-               self.has_failed = 1
+        # cars sharing a cell crash, except at (0, 0) where dead cars are put
+        cell = self.car_loc[:, 0] * self.dims[1] + self.car_loc[:, 1]
+        crashed = (np.bincount(cell)[cell] > 1) & (cell != 0)
+        if crashed.any():
+            reward[crashed] += self.CRASH_PENALTY
+            self.has_failed = 1
 
         reward = self.alive_mask * reward
         return reward
@@ -606,17 +629,14 @@ class TrafficJunctionEnv(gym.Env):
     def reward_terminal(self):
         return np.zeros_like(self._get_reward())
 
-    def _choose_dead(self):
-        # all idx
-        car_idx = np.arange(len(self.alive_mask))
-        # random choice of idx from dead ones.
-        return np.random.choice(car_idx[self.alive_mask == 0])
-
     def curriculum(self, epoch):
+        if self.curr_start <= epoch <= self.curr_end:
+            self.add_rate = self._curriculum_rate(epoch)
+
+    def _curriculum_rate(self, epoch):
         step_size = 0.01
         upgrade_gap = (self.curr_end - self.curr_start) / 100 / (self.add_rate_max - self.add_rate_min)
-        if self.curr_start <= epoch <= self.curr_end:
-            self.add_rate = round(self.add_rate_min + step_size * math.floor((epoch - self.curr_start) / upgrade_gap), 2)
+        return round(self.add_rate_min + step_size * math.floor((epoch - self.curr_start) / upgrade_gap), 2)
         # if self.curr_start <= epoch <= self.curr_end:
         #     self.exact_rate = self.exact_rate + step
         #     self.add_rate = step_size * (self.exact_rate // step_size)
\ No newline at end of file
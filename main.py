@@ -13,7 +13,9 @@ from comm import CommNetMLP
 from utils import *
 from action_utils import parse_action_args
 from trainer import Trainer
-from multi_processing import MultiProcessTrainer
+from multi_processing import MultiProcessTrainer, AsyncMultiProcessTrainer
+from actor_learner import ActorLearnerTrainer
+from distributed import DistributedTrainer
 
 torch.utils.backcompat.broadcast_warning.enabled = True
 torch.utils.backcompat.keepdim_warning.enabled = True
@@ -33,6 +35,34 @@ parser.add_argument('--batch_size', type=int, default=500,
 # for medium, 500//40 + 1 = 13 episodes before each update. The last episode is not 40 steps.
 parser.add_argument('--nprocesses', type=int, default=16,
                     help='How many processes to run')
+parser.add_argument('--worker_timeout', type=float, default=0,
+                    help='Seconds a worker may spend on a batch before it is restarted. 0 to wait forever')
+parser.add_argument('--min_workers', type=int, default=-1,
+                    help='Update with the first min_workers worker batches and drop the stragglers. -1 to wait for all')
+parser.add_argument('--hogwild', action='store_true', default=False,
+                    help='Asynchronous training: each process applies its own gradients to the shared model')
+parser.add_argument('--max_staleness', type=int, default=16,
+                    help='With --hogwild, drop gradients of batches that started more than this many updates ago. -1 for no limit')
+parser.add_argument('--distributed', action='store_true', default=False,
+                    help='Train with torch.distributed, one trainer per rank (--nprocesses is not used), launch the ranks with torchrun')
+parser.add_argument('--dist_backend', default='gloo',
+                    help='torch.distributed backend')
+parser.add_argument('--dist_url', default='env://',
+                    help='torch.distributed init_method, env:// reads MASTER_ADDR and MASTER_PORT')
+parser.add_argument('--world_size', type=int, default=-1,
+                    help='number of ranks, -1 to read WORLD_SIZE')
+parser.add_argument('--rank', type=int, default=-1,
+                    help='rank of this process, -1 to read RANK')
+parser.add_argument('--actor_learner', action='store_true', default=False,
+                    help='nprocesses-1 actors collect episodes, the main process learns from them with V-trace')
+parser.add_argument('--actor_refresh', type=int, default=1,
+                    help='With --actor_learner, episodes an actor runs before copying the latest policy')
+parser.add_argument('--nenvs', type=int, default=1,
+                    help='How many envs each process steps together, with one batched forward')
+parser.add_argument('--async_envs', action='store_true', default=False,
+                    help='Step the envs of --nenvs in their own processes, overlapping with the forward')
+parser.add_argument('--batch_env', action='store_true', default=False,
+                    help='Simulate the envs of --nenvs in the arrays of one batched env, traffic_junction only')
 # model
 parser.add_argument('--hid_size', default=64, type=int,
                     help='hidden layer size')
@@ -42,7 +72,9 @@ parser.add_argument('--recurrent', action='store_true', default=False,
 parser.add_argument('--gamma', type=float, default=1.0,
                     help='discount factor')
 parser.add_argument('--tau', type=float, default=1.0,
-                    help='gae (remove?)')
+                    help='lambda of GAE, used with --gae')
+parser.add_argument('--gae', action='store_true', default=False,
+                    help='use GAE(tau) advantages, bootstrapped at episodes cut by max_steps')
 parser.add_argument('--seed', type=int, default=-1,
                     help='random seed. Pass -1 for random seed') # TODO: works in thread?
 parser.add_argument('--normalize_rewards', action='store_true', default=False,
@@ -110,6 +142,31 @@ parser.add_argument('--advantages_per_action', default=False, action='store_true
                     help='Whether to multipy log porb for each chosen action with advantages')
 parser.add_argument('--share_weights', default=False, action='store_true',
                     help='Share weights for hops')
+parser.add_argument('--comm_neighbors', default=0, type=int,
+                    help='Communicate only with this many nearest agents (by location in env info). 0 for all-to-all. '
+                         'avg comm_mode still divides by the number of other alive agents, as all-to-all does')
+parser.add_argument('--comm_radius', default=-1, type=float,
+                    help='Communicate only with agents within this distance (by location in env info). -1 for no limit')
+# channel
+parser.add_argument('--channel', default='csma_loop', type=str,
+                    help='MAC model of the communication channel. csma_loop, csma (vectorized, faster from ~4 envs '
+                    + 'per call), csma_table (sampled from a precomputed table) '
+                    + 'and csma_torch (on torch tensors) simulate CSMA/BEB '
+                    + '[csma_loop|csma|csma_table|csma_torch|ideal|bernoulli|aloha|tdma]')
+parser.add_argument('--comm_phase', default=60, type=int,
+                    help='length of the communication phase in time slots')
+parser.add_argument('--frame_slots', default=10, type=int,
+                    help='time slots taken by transmitting one message')
+parser.add_argument('--init_window', default=3, type=int,
+                    help='initial contention window of CSMA/BEB')
+parser.add_argument('--max_window', default=15, type=int,
+                    help='contention window cap of CSMA/BEB')
+parser.add_argument('--loss_rate', default=0.1, type=float,
+                    help='probability of losing a message in bernoulli channel')
+parser.add_argument('--tx_prob', default=0.3, type=float,
+                    help='transmit probability per frame in aloha channel')
+parser.add_argument('--channel_seed', default=-1, type=int,
+                    help='seed of the csma_torch channel generator. Pass -1 to use the global torch generator')
 
 
 init_args_for_env(parser)
@@ -184,10 +241,22 @@ if not args.display:
 for p in policy_net.parameters():
     p.data.share_memory_()
 
-if args.nprocesses > 1:
-    trainer = MultiProcessTrainer(args, lambda: Trainer(args, policy_net, data.init(args.env_name, args)))
+def make_env():
+    if args.nenvs > 1:
+        return data.init_vector(args.env_name, args, args.nenvs, asynchronous=args.async_envs,
+                                batched=args.batch_env)
+    return data.init(args.env_name, args)
+
+if args.distributed:
+    trainer = DistributedTrainer(args, lambda: Trainer(args, policy_net, make_env()))
+elif args.nprocesses > 1 and args.actor_learner:
+    trainer = ActorLearnerTrainer(args, policy_net, lambda: data.init(args.env_name, args))
+elif args.nprocesses > 1 and args.hogwild:
+    trainer = AsyncMultiProcessTrainer(args, lambda: Trainer(args, policy_net, make_env()))
+elif args.nprocesses > 1:
+    trainer = MultiProcessTrainer(args, lambda: Trainer(args, policy_net, make_env()))
 else:
-    trainer = Trainer(args, policy_net, data.init(args.env_name, args))
+    trainer = Trainer(args, policy_net, make_env())
 
 disp_trainer = Trainer(args, policy_net, data.init(args.env_name, args, False))
 disp_trainer.display = True
@@ -202,6 +271,7 @@ log['enemy_reward'] = LogField(list(), True, 'epoch', 'num_episodes')
 log['success'] = LogField(list(), True, 'epoch', 'num_episodes')
 log['steps_taken'] = LogField(list(), True, 'epoch', 'num_episodes')
 log['add_rate'] = LogField(list(), True, 'epoch', 'num_episodes')
+log['policy_lag'] = LogField(list(), True, 'epoch', 'num_episodes')
 
 log['comm_action'] = LogField(list(), True, 'epoch', 'num_steps')
 log['enemy_comm'] = LogField(list(), True, 'epoch', 'num_steps')
@@ -209,10 +279,23 @@ log['value_loss'] = LogField(list(), True, 'epoch', 'num_steps')
 log['action_loss'] = LogField(list(), True, 'epoch', 'num_steps')
 log['entropy'] = LogField(list(), True, 'epoch', 'num_steps')
 
+log['channel_contenders'] = LogField(list(), True, 'epoch', 'channel_phases')
+log['channel_attempts'] = LogField(list(), True, 'epoch', 'channel_phases')
+log['channel_successes'] = LogField(list(), True, 'epoch', 'channel_phases')
+log['channel_collisions'] = LogField(list(), True, 'epoch', 'channel_phases')
+log['channel_idle_slots'] = LogField(list(), True, 'epoch', 'channel_phases')
+
+# seconds per epoch in each phase, summed over processes. obs is part of env_reset and env_step, channel part of forward
+phases = ['env_reset', 'env_step', 'obs', 'forward', 'channel', 'action', 'compute_grad', 'backward',
+          'reduce', 'optimizer', 'logging']
+for phase in phases:
+    log['time_' + phase] = LogField(list(), False, 'epoch', None)
+
 if args.plot:
     vis = visdom.Visdom(env=args.plot_env)
 
 def run(num_epochs):
+    log_time = 0
     for ep in range(num_epochs):
         epoch_begin_time = time.time()
         stat = dict()
@@ -224,6 +307,9 @@ def run(num_epochs):
             trainer.display = False
 
         epoch_time = time.time() - epoch_begin_time
+        # logging of the last epoch, done after its stats were printed
+        stat['time_logging'] = log_time
+        log_begin_time = time.time()
         epoch = len(log['epoch'].data) + 1
         for k, v in log.items():
             if k == 'epoch':
@@ -233,6 +319,10 @@ def run(num_epochs):
                     stat[k] = stat[k] / stat[v.divide_by]
                 v.data.append(stat.get(k, 0))
 
+        if args.distributed and not trainer.is_master:
+            # every rank has the same stat, rank 0 reports and saves
+            continue
+
         np.set_printoptions(precision=2)
 
         print('Epoch {} \t Reward {} \tTime {:.2f}s'.format(
@@ -257,6 +347,32 @@ def run(num_epochs):
         if 'enemy_comm' in stat.keys():
             print('Enemy-Comm: {}'.format(stat['enemy_comm']))
             res_file.write('\nEnemy-Comm: {}'.format(stat['enemy_comm']))
+        if 'channel_phases' in stat.keys():
+            # per contention phase
+            channel = ' '.join('{} {:.2f}'.format(k[len('channel_'):], stat[k]) for k in
+                               ['channel_contenders', 'channel_attempts', 'channel_successes',
+                                'channel_collisions', 'channel_idle_slots'] if k in stat)
+            print('Channel: {}'.format(channel))
+            res_file.write('\nChannel: {}'.format(channel))
+        if 'async_updates' in stat.keys() or 'stale_batches' in stat.keys():
+            updates = stat.get('async_updates', 0)
+            print('Async: updates {} stale-dropped {} mean-staleness {:.2f}'.format(
+                updates, stat.get('stale_batches', 0), stat.get('staleness', 0) / max(1, updates)))
+            res_file.write('\nAsync: updates {} stale-dropped {}'.format(updates, stat.get('stale_batches', 0)))
+        if 'worker_steps' in stat.keys():
+            rate = stat['worker_steps'] / np.maximum(stat['worker_time'], 1e-6)
+            print('Workers: steps/s {} dropped {} restarts {} timeouts {}'.format(rate,
+                stat.get('dropped_batches', 0), stat.get('worker_restarts', 0), stat.get('worker_timeouts', 0)))
+            res_file.write('\nWorkers: dropped {} restarts {} timeouts {}'.format(
+                stat.get('dropped_batches', 0), stat.get('worker_restarts', 0), stat.get('worker_timeouts', 0)))
+        if 'channel_backoff' in stat.keys():
+            backoff = stat['channel_backoff'] / max(1, stat['channel_backoff'].sum())
+            print('Channel-Backoff: {}'.format(backoff))
+            res_file.write('\nChannel-Backoff: {}'.format(backoff))
+        if 'time_forward' in stat.keys():
+            times = ' '.join('{} {:.2f}s'.format(k, stat['time_' + k]) for k in phases if 'time_' + k in stat)
+            print('Phases: {}'.format(times))
+            res_file.write('\nPhases: {}'.format(times))
 
         if args.plot:
             for k, v in log.items():
@@ -272,6 +388,7 @@ def run(num_epochs):
 
         if args.save != '':
             save(args.save)
+        log_time = time.time() - log_begin_time
 
 def save(path):
     d = dict()
@@ -304,10 +421,14 @@ res_file.close()
 if args.display:
     env.end_display()
 
-if args.save != '':
+if args.save != '' and (not args.distributed or trainer.is_master):
     save(args.save)
 
-if sys.flags.interactive == 0 and args.nprocesses > 1:
+if args.distributed:
+    trainer.quit()
+elif sys.flags.interactive == 0 and args.nprocesses > 1:
     trainer.quit()
     import os
     os._exit(0)
+elif sys.flags.interactive == 0:
+    trainer.quit()
@@ -1,16 +1,19 @@
 import time
+import queue
 from utils import *
 import torch
 import torch.multiprocessing as mp
+from multiprocessing.connection import wait
 
 class MultiProcessWorker(mp.Process):
     # TODO: Make environment init threadsafe
-    def __init__(self, id, trainer_maker, comm, seed, *args, **kwargs):
+    def __init__(self, id, trainer_maker, comm, seed, grad_buffer, *args, **kwargs):
         self.id = id
         self.seed = seed
         super(MultiProcessWorker, self).__init__()
         self.trainer = trainer_maker()
         self.comm = comm
+        self.grad_buffer = grad_buffer[id]  # flat grads of this worker, in shared memory
 
     def run(self):
         torch.manual_seed(self.seed + self.id + 1)
@@ -28,73 +31,270 @@ class MultiProcessWorker(mp.Process):
                 self.trainer.optimizer.zero_grad()
                 s = self.trainer.compute_grad(batch)
                 merge_stat(s, stat)
+                copy_flat_grad_to(self.trainer.params, self.grad_buffer)
                 self.comm.send(stat)
-            elif task == 'send_grads':
-                grads = []
-                for p in self.trainer.params:
-                    if p._grad is not None:
-                        grads.append(p._grad.data)
-
-                self.comm.send(grads)
 
 
 class MultiProcessTrainer(object):
     def __init__(self, args, trainer_maker):
         self.comms = []
+        self.workers = []
+        self.trainer_maker = trainer_maker
         self.trainer = trainer_maker()
         # itself will do the same job as workers
         self.nworkers = args.nprocesses - 1
+        # one row of flat grads per worker, and the flat grads of this process
+        nparams = sum(p.numel() for p in self.trainer.params)
+        dtype = self.trainer.params[0].dtype
+        self.worker_grads = torch.zeros(self.nworkers, nparams, dtype=dtype).share_memory_()
+        self.grads = torch.zeros(nparams, dtype=dtype)
+        self.seed = args.seed
+        # seconds a worker may spend on a batch before it is restarted, 0 to wait forever
+        self.timeout = args.worker_timeout if hasattr(args, 'worker_timeout') else 0
+        # update with the first min_workers results, the other workers' batches are dropped
+        self.min_workers = args.min_workers if hasattr(args, 'min_workers') and args.min_workers >= 0 else self.nworkers
+        self.sent = [None] * self.nworkers  # when the running batch of each worker was sent, None if idle
+        self.restarts = [0] * self.nworkers
         for i in range(self.nworkers):
-            comm, comm_remote = mp.Pipe()
-            self.comms.append(comm)
-            worker = MultiProcessWorker(i, trainer_maker, comm_remote, seed=args.seed)
-            worker.start()
-        self.grads = None
-        self.worker_grads = None
+            self.start_worker(i)
         self.is_random = args.random
 
+    def start_worker(self, i):
+        comm, comm_remote = mp.Pipe()
+        # a restarted worker does not replay the episodes of the one it replaces
+        worker = MultiProcessWorker(i, self.trainer_maker, comm_remote, seed=self.seed + self.nworkers * self.restarts[i],
+                                    grad_buffer=self.worker_grads)
+        worker.start()
+        if i < len(self.comms):
+            self.comms[i] = comm
+            self.workers[i] = worker
+        else:
+            self.comms.append(comm)
+            self.workers.append(worker)
+        self.sent[i] = None
+
+    def restart_worker(self, i):
+        self.workers[i].terminate()
+        self.workers[i].join()
+        self.workers[i].trainer.quit()   # its envs were made in this process
+        self.restarts[i] += 1
+        self.start_worker(i)
+
     def quit(self):
         for comm in self.comms:
             comm.send('quit')
+        # the workers' trainers and their envs were made in this process, so they are closed here
+        for worker in self.workers:
+            worker.join(self.timeout if self.timeout > 0 else None)
+            if worker.is_alive():   # hung in a batch
+                worker.terminate()
+                worker.join()
+            worker.trainer.quit()
+        self.trainer.quit()
 
-    def obtain_grad_pointers(self):
-        # only need perform this once
-        if self.grads is None:
-            self.grads = []
-            for p in self.trainer.params:
-                if p._grad is not None:
-                    self.grads.append(p._grad.data)
+    def check_workers(self, workers, stat):
+        '''
+        Restart the workers that died, or that ran their batch for longer than timeout
+        output:
+            workers: the ones still running
+        '''
+        running = []
+        for i in workers:
+            if self.comms[i].poll():
+                running.append(i)
+            elif not self.workers[i].is_alive():
+                self.restart_worker(i)
+                stat['worker_restarts'] = stat.get('worker_restarts', 0) + 1
+            elif self.timeout > 0 and time.time() - self.sent[i] > self.timeout:
+                self.restart_worker(i)
+                stat['worker_timeouts'] = stat.get('worker_timeouts', 0) + 1
+            else:
+                running.append(i)
+        return running
 
-        if self.worker_grads is None:
-            self.worker_grads = []
-            for comm in self.comms:
-                comm.send('send_grads')
-                self.worker_grads.append(comm.recv())
+    def recv(self, i, stat):
+        '''
+        Result of worker i, counted into its step rate
+        '''
+        s = self.comms[i].recv()
+        stat['worker_steps'][i] += s['num_steps']
+        stat['worker_time'][i] += time.time() - self.sent[i]
+        self.sent[i] = None
+        return s
 
     def train_batch(self, epoch):
-        # run workers in parallel
-        for comm in self.comms:
-            comm.send(['run_batch', epoch])
+        '''
+        output:
+            stat: merged stat of its own batch and of the workers' batches used for the update,
+                  with 'worker_steps' and 'worker_time' arrays for the step rate of each worker
+        '''
+        stat = dict()
+        stat['worker_steps'] = np.zeros(self.nworkers)
+        stat['worker_time'] = np.zeros(self.nworkers)
+
+        # stragglers dropped from the last update, their results come too late to use
+        busy = self.check_workers([i for i in range(self.nworkers) if self.sent[i] is not None], stat)
+        for i in busy:
+            if self.comms[i].poll():
+                self.recv(i, stat)
+                stat['dropped_batches'] = stat.get('dropped_batches', 0) + 1
+
+        # run idle workers in parallel
+        running = [i for i in range(self.nworkers) if self.sent[i] is None]
+        for i in running:
+            self.comms[i].send(['run_batch', epoch])
+            self.sent[i] = time.time()
 
         # run its own trainer
-        batch, stat = self.trainer.run_batch(epoch)
+        batch, s = self.trainer.run_batch(epoch)
         self.trainer.optimizer.zero_grad()
-        s = self.trainer.compute_grad(batch)
+        merge_stat(self.trainer.compute_grad(batch), s)
         merge_stat(s, stat)
 
-        # check if workers are finished
-        for comm in self.comms:
-            s = comm.recv()
-            merge_stat(s, stat)
+        # wait for the first min_workers results, or for all of them if fewer are left running
+        results = dict()
+        while len(results) < min(self.min_workers, len(running)):
+            pending = [i for i in running if i not in results]
+            deadline = None if self.timeout <= 0 else max(0, min(self.sent[i] for i in pending) + self.timeout - time.time())
+            wait([self.comms[i] for i in pending] + [self.workers[i].sentinel for i in pending], deadline)
+            for i in pending:
+                if self.comms[i].poll():
+                    results[i] = self.recv(i, stat)
+            running = list(results) + self.check_workers([i for i in pending if i not in results], stat)
+        done = sorted(results)
+        for i in done:
+            merge_stat(results[i], stat)
+
+        # add gradients of workers, all in one pass over the flat buffers
+        timer = self.trainer.timer
+        with timer('reduce'):
+            copy_flat_grad_to(self.trainer.params, self.grads)
+            if len(done) == self.nworkers:
+                self.grads += self.worker_grads.sum(0)
+            elif len(done) > 0:
+                self.grads += self.worker_grads[torch.LongTensor(done)].sum(0)
+            self.grads /= stat['num_steps']
+            set_flat_grad_to(self.trainer.params, self.grads)
+
+        with timer('optimizer'):
+            self.trainer.optimizer.step()
+        merge_stat(timer.get_stat(), stat)
+        return stat
+
+    def state_dict(self):
+        return self.trainer.state_dict()
+
+    def load_state_dict(self, state):
+        self.trainer.load_state_dict(state)
+
+
+def train_async_batch(trainer, epoch, version, max_staleness):
+    '''
+    Run a batch and apply its gradients to the shared policy_net right away (Hogwild, no lock on params).
+    The update is dropped if more than max_staleness updates landed since the batch started.
+    output:
+        stat: stat of the batch, with 'async_updates' and 'staleness', or 'stale_batches'
+    '''
+    start = version.value
+    batch, stat = trainer.run_batch(epoch)
+    trainer.optimizer.zero_grad()
+    s = trainer.compute_grad(batch)
+    merge_stat(s, stat)
+
+    staleness = version.value - start
+    if max_staleness >= 0 and staleness > max_staleness:
+        stat['stale_batches'] = 1
+        return stat
+
+    for p in trainer.params:
+        if p._grad is not None:
+            p._grad.data /= stat['num_steps']
+    with trainer.timer('optimizer'):
+        trainer.optimizer.step()
+    merge_stat(trainer.timer.get_stat(), stat)
+    with version.get_lock():
+        version.value += 1
+    stat['async_updates'] = 1
+    stat['staleness'] = staleness
+    return stat
 
-        # add gradients of workers
-        self.obtain_grad_pointers()
-        for i in range(len(self.grads)):
-            for g in self.worker_grads:
-                self.grads[i] += g[i]
-            self.grads[i] /= stat['num_steps']
 
-        self.trainer.optimizer.step()
+class AsyncMultiProcessWorker(mp.Process):
+    def __init__(self, id, trainer_maker, queue, version, epoch, stop, seed, max_staleness):
+        self.id = id
+        self.seed = seed
+        super(AsyncMultiProcessWorker, self).__init__()
+        self.trainer = trainer_maker()
+        self.queue = queue
+        self.version = version
+        self.epoch = epoch
+        self.stop = stop
+        self.max_staleness = max_staleness
+
+    def run(self):
+        torch.manual_seed(self.seed + self.id + 1)
+        np.random.seed(self.seed + self.id + 1)
+
+        while not self.stop.is_set():
+            stat = train_async_batch(self.trainer, self.epoch.value, self.version, self.max_staleness)
+            self.queue.put(stat)
+
+
+class AsyncMultiProcessTrainer(object):
+    '''
+    Workers keep running batches and each applies its own gradients to the shared policy_net,
+    without waiting for each other. Stats come back through a queue.
+    '''
+    quit_timeout = 30   # seconds quit() lets a worker finish its batch before terminating it
+
+    def __init__(self, args, trainer_maker):
+        self.trainer = trainer_maker()
+        # itself will do the same job as workers
+        self.nworkers = args.nprocesses - 1
+        self.queue = mp.Queue()
+        self.version = mp.Value('i', 0)     # number of updates applied to policy_net
+        self.epoch = mp.Value('i', 0)
+        self.stop = mp.Event()
+        self.max_staleness = args.max_staleness
+        self.workers = []
+        for i in range(self.nworkers):
+            worker = AsyncMultiProcessWorker(i, trainer_maker, self.queue, self.version, self.epoch, self.stop,
+                                             seed=args.seed, max_staleness=args.max_staleness)
+            worker.start()
+            self.workers.append(worker)
+
+    def quit(self):
+        self.stop.set()
+        # a worker only exits once the stat it put is read from the queue, so keep draining it
+        deadline = time.time() + self.quit_timeout
+        for worker in self.workers:
+            while worker.is_alive() and time.time() < deadline:
+                self.drain()
+                worker.join(0.1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            worker.trainer.quit()   # its envs were made in this process
+        self.drain()
+        self.trainer.quit()
+
+    def drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def train_batch(self, epoch):
+        '''
+        output:
+            stat: merged stat of its own batch and of the next nprocesses-1 batches finished by workers,
+                  so an epoch covers as many steps as with MultiProcessTrainer
+        '''
+        self.epoch.value = epoch
+        stat = train_async_batch(self.trainer, epoch, self.version, self.max_staleness)
+        for _ in range(self.nworkers):
+            merge_stat(self.queue.get(), stat)
         return stat
 
     def state_dict(self):
@@ -0,0 +1,89 @@
+from collections import namedtuple
+import numpy as np
+import torch
+
+# one batch of steps, each field concatenated over steps, episodes contiguous
+Batch = namedtuple('Batch', ('state', 'action', 'action_out', 'value', 'episode_mask', 'episode_mini_mask',
+                             'reward', 'alive_mask', 'next_value'))
+
+def as_tensor(x):
+    return x if torch.is_tensor(x) else torch.from_numpy(np.asarray(x))
+
+class RolloutBuffer(object):
+    '''
+    Preallocated storage for the steps of a batch, one contiguous tensor per field written in place.
+    Steps of several envs (lanes) can come interleaved, get() returns each episode contiguous.
+    action_out and value carry the graph of the policy forward, they are kept in lists
+    and concatenated once in get().
+    '''
+    fields = ('state', 'action', 'reward', 'episode_mask', 'episode_mini_mask', 'alive_mask', 'next_value')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = dict()  # field -> tensor[capacity, ...], allocated at the first add()
+        self.clear()
+
+    def clear(self):
+        self.size = 0
+        self.action_out = []
+        self.value = []
+        self.order = []     # rows of finished episodes, in the order they finished
+        self.running = dict()   # lane -> rows of its running episode
+
+    def add(self, lane=0, action_out=None, value=None, next_value=None, **fields):
+        '''
+        input:
+            lane: env the step comes from
+            action_out, value: outputs of the policy forward for this step
+            next_value: bootstrap value of the step, zeros if None
+            fields: the other fields of the step, arrays or tensors
+        output:
+            row: row of the step in the buffer
+        '''
+        if len(self.data) == 0:
+            for name, x in fields.items():
+                self.data[name] = torch.zeros((self.capacity,) + as_tensor(x).shape)
+            self.data['next_value'] = torch.zeros_like(self.data['reward'])
+        elif self.size == self.capacity:
+            self.grow()
+
+        row = self.size
+        self.size += 1
+        for name, x in fields.items():
+            self.data[name][row] = as_tensor(x)
+        self.data['next_value'][row] = 0 if next_value is None else as_tensor(next_value)
+        self.action_out.append(action_out)
+        self.value.append(value.view(1, -1))
+        self.running.setdefault(lane, []).append(row)
+        return row
+
+    def add_reward(self, row, reward):
+        self.data['reward'][row] += as_tensor(reward)
+
+    def end_episode(self, lane=0):
+        '''
+        output:
+            rows: rows of the episode that just ended in lane
+        '''
+        rows = self.running.pop(lane, [])
+        self.order += rows
+        return rows
+
+    def grow(self):
+        for name, x in self.data.items():
+            self.data[name] = torch.cat([x, torch.zeros_like(x)])
+        self.capacity *= 2
+
+    def get(self):
+        '''
+        output:
+            batch: Batch of the finished episodes, e.g. reward tensor[520, 10]
+        '''
+        order = torch.LongTensor(self.order)
+        if isinstance(self.action_out[0], tuple):    # continuous
+            action_out = tuple(torch.cat(a)[order] for a in zip(*self.action_out))
+        else:
+            action_out = [torch.cat(a)[order] for a in zip(*self.action_out)]
+        value = torch.cat(self.value)[order]
+        return Batch(action_out=action_out, value=value,
+                     **{name: self.data[name][order] for name in self.fields})
@@ -1,4 +1,4 @@
-from collections import namedtuple
+import time
 from inspect import getargspec
 import numpy as np
 import torch
@@ -6,9 +6,7 @@ from torch import optim
 import torch.nn as nn
 from utils import *
 from action_utils import *
-
-Transition = namedtuple('Transition', ('state', 'action', 'action_out', 'value', 'episode_mask', 'episode_mini_mask', 'next_state',
-                                       'reward', 'misc'))
+from rollout import RolloutBuffer
 
 class Trainer(object):
     def __init__(self, args, policy_net, env):
@@ -21,13 +19,17 @@ class Trainer(object):
         self.optimizer = optim.RMSprop(policy_net.parameters(),
             lr = args.lrate, alpha=0.97, eps=1e-6)
         self.params = [p for p in self.policy_net.parameters()]
+        # room for a batch and the episodes running over it
+        nenvs = env.num_envs if hasattr(env, 'num_envs') else 1
+        self.buffer = RolloutBuffer(args.batch_size + nenvs * args.max_steps)
+        self.timer = PhaseTimer()
 
     def get_episode(self, epoch):
         '''
         input:epoch
         
         output:
-            episode: a list of Transitions \n
+            episode: rows of the steps of the episode in self.buffer \n
             stat: a dict:
                     {
                         'reward':array([  0.  ,  -1.2 , -12.56,   0.  ,   0.  ,   0.  ,   0.  , -11.9 ,
@@ -38,16 +40,15 @@ class Trainer(object):
                         'add_rate':0.02
                     }
         '''
-        episode = []
-        
         # Get the names and default values of a function's parameters.
         reset_args = getargspec(self.env.reset).args
         
         # episode初始化
-        if 'epoch' in reset_args:
-            state = self.env.reset(epoch)   # state: [1, 10, 61]
-        else:
-            state = self.env.reset()
+        with self.timer('env_reset'):
+            if 'epoch' in reset_args:
+                state = self.env.reset(epoch)   # state: [1, 10, 61]
+            else:
+                state = self.env.reset()
         
         should_display = self.display and self.last_step
 
@@ -60,8 +61,6 @@ class Trainer(object):
         prev_hid = torch.zeros(1, self.args.nagents, self.args.hid_size)    # [1,10,128]
 
         for t in range(self.args.max_steps):
-            misc = dict()
-            
             if t == 0 and self.args.hard_attn and self.args.commnet:
                 info['comm_action'] = np.zeros(self.args.nagents, dtype=int)
 
@@ -72,7 +71,8 @@ class Trainer(object):
                     # ([10,128], [10,128]), full of zero, [prev_hidden, prev_cell]
                 
                 x = [state, prev_hid]
-                action_out, value, prev_hid = self.policy_net(x, info)
+                with self.timer('forward'):
+                    action_out, value, prev_hid = self.policy_net(x, info)
 
                 if (t + 1) % self.args.detach_gap == 0:
                     if self.args.rnn_type == 'LSTM':
@@ -81,11 +81,14 @@ class Trainer(object):
                         prev_hid = prev_hid.detach()
             else:
                 x = state
-                action_out, value = self.policy_net(x, info)
-
-            action = select_action(self.args, action_out)
-            action, actual = translate_action(self.args, self.env, action)
-            next_state, reward, done, info = self.env.step(actual)
+                with self.timer('forward'):
+                    action_out, value = self.policy_net(x, info)
+
+            with self.timer('action'):
+                action = select_action(self.args, action_out)
+                action, actual = translate_action(self.args, self.env, action)
+            with self.timer('env_step'):
+                next_state, reward, done, info = self.env.step(actual)
             # next_state: [1, 10, 61]
             # reward: (10,)
             # done: bool
@@ -100,19 +103,20 @@ class Trainer(object):
                     stat['enemy_comm']  = stat.get('enemy_comm', 0)  + info['comm_action'][self.args.nfriendly:]
 
             if 'alive_mask' in info:
-                misc['alive_mask'] = info['alive_mask'].reshape(reward.shape)
+                alive_mask = info['alive_mask'].reshape(reward.shape)
             else:
-                misc['alive_mask'] = np.ones_like(reward)
+                alive_mask = np.ones_like(reward)
 
             # env should handle this make sure that reward for dead agents is not counted
-            # reward = reward * misc['alive_mask']
+            # reward = reward * alive_mask
 
             stat['reward'] = stat.get('reward', 0) + reward[:self.args.nfriendly]   # add rewards up
             # D.get(k[,d]) -> D[k] if k in D, else d. d defaults to None.
             if hasattr(self.args, 'enemy_comm') and self.args.enemy_comm:
                 stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward[self.args.nfriendly:]
 
-            done = done or t == self.args.max_steps - 1
+            truncated = not done and t == self.args.max_steps - 1
+            done = done or truncated
 
             episode_mask = np.ones(reward.shape)
             episode_mini_mask = np.ones(reward.shape)
@@ -126,15 +130,22 @@ class Trainer(object):
             if should_display:
                 self.env.display()
 
-            trans = Transition(state, action, action_out, value, episode_mask, episode_mini_mask, next_state, reward, misc)
+            next_value = None
+            if truncated and self.args.gae:
+                next_value = self.bootstrap_value(next_state, prev_hid if self.args.recurrent else None, info,
+                                                  getattr(self.policy_net, 'senters', None))[0]
+
             # action_out: [1,10,2]
             # value: [10,1]
-            episode.append(trans)
+            self.buffer.add(state=state, action=action, action_out=action_out, value=value,
+                            episode_mask=episode_mask, episode_mini_mask=episode_mini_mask, reward=reward,
+                            alive_mask=alive_mask, next_value=next_value)
             
             state = next_state
             if done:
                 break
         
+        episode = self.buffer.end_episode()
         stat['num_steps'] = t + 1   # 就是max_steps=40
         stat['steps_taken'] = stat['num_steps']
 
@@ -142,9 +153,9 @@ class Trainer(object):
             reward = self.env.reward_terminal()
             # We are not multiplying in case of reward terminal with alive agent
             # If terminal reward is masked environment should do
-            # reward = reward * misc['alive_mask']
+            # reward = reward * alive_mask
 
-            episode[-1] = episode[-1]._replace(reward = episode[-1].reward + reward)
+            self.buffer.add_reward(episode[-1], reward)
             stat['reward'] = stat.get('reward', 0) + reward[:self.args.nfriendly]
             if hasattr(self.args, 'enemy_comm') and self.args.enemy_comm:
                 stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward[self.args.nfriendly:]
@@ -152,16 +163,20 @@ class Trainer(object):
         # 这里获得success
         if hasattr(self.env, 'get_stat'):
             merge_stat(self.env.get_stat(), stat)
+        # channel counters of this episode
+        if hasattr(self.policy_net, 'channel'):
+            merge_stat(self.policy_net.channel.get_stat(), stat)
         return (episode, stat)
 
     def compute_grad(self, batch):
         '''
         input:
-            batch: a single Transition but each named element is a tuple filled with all corresponding elemtns from each Transition in batch from get_episode()
+            batch: a rollout.Batch from run_batch(), each field holds all steps, e.g. reward tensor[520, 10]
         output:
             stat: a dictionary that contains action_loss, value_loss, entropy
         what's done in this function: compute loss and let loss backward~
         '''
+        start = time.time()
         stat = dict()
         num_actions = self.args.num_actions # [2]
         dim_actions = self.args.dim_actions # 1
@@ -169,48 +184,43 @@ class Trainer(object):
         n = self.args.nagents   # 10
         batch_size = len(batch.state)   # 520
 
-        rewards = torch.Tensor(batch.reward)
-        episode_masks = torch.Tensor(batch.episode_mask)
-        episode_mini_masks = torch.Tensor(batch.episode_mini_mask)
-        actions = torch.Tensor(batch.action)
-        actions = actions.transpose(1, 2).view(-1, n, dim_actions)  # [520, 10, 1]
-
-        # old_actions = torch.Tensor(np.concatenate(batch.action, 0))
-        # old_actions = old_actions.view(-1, n, dim_actions)
-        # print(old_actions == actions)
+        rewards = batch.reward
+        episode_masks = batch.episode_mask
+        episode_mini_masks = batch.episode_mini_mask
+        actions = batch.action
+        actions = actions.transpose(1, 2).contiguous().view(-1, n, dim_actions)  # [520, 10, 1]
 
         # can't do batch forward.
-        values = torch.cat(batch.value, dim=0)
-        action_out = list(zip(*batch.action_out))
-        action_out = [torch.cat(a, dim=0) for a in action_out]
-        # misc中就只有alive_mask
-        alive_masks = torch.Tensor(np.concatenate([item['alive_mask'] for item in batch.misc])).view(-1)
+        values = batch.value
+        action_out = batch.action_out
+        alive_masks = batch.alive_mask.view(-1)
         # alive_masks：torch.Size([5200])
-        coop_returns = torch.Tensor(batch_size, n)
-        ncoop_returns = torch.Tensor(batch_size, n)
-        returns = torch.Tensor(batch_size, n)
-        deltas = torch.Tensor(batch_size, n)
-        advantages = torch.Tensor(batch_size, n)
         values = values.view(batch_size, n)
 
-        prev_coop_return = 0
-        prev_ncoop_return = 0
-        prev_value = 0
-        prev_advantage = 0
-
-        for i in reversed(range(rewards.size(0))):
-            coop_returns[i] = rewards[i] + self.args.gamma * prev_coop_return * episode_masks[i]
-            ncoop_returns[i] = rewards[i] + self.args.gamma * prev_ncoop_return * episode_masks[i] * episode_mini_masks[i]
-
-            prev_coop_return = coop_returns[i].clone()
-            prev_ncoop_return = ncoop_returns[i].clone()
-
-            returns[i] = (self.args.mean_ratio * coop_returns[i].mean()) \
-                        + ((1 - self.args.mean_ratio) * ncoop_returns[i])
+        if self.args.gae:
+            # GAE(tau), values of next steps, and bootstrap values where max_steps cut the episode, [520, 10]
+            next_values = torch.zeros(batch_size, n)
+            next_values[:-1] = values.data[1:]
+            bootstrap_values = batch.next_value
+
+            def gae(rewards, masks):
+                deltas = rewards + self.args.gamma * (next_values * masks + bootstrap_values) - values.data
+                return discounted_returns(deltas, self.args.gamma * self.args.tau * masks)
+
+            coop_advantages = gae(rewards.mean(1, keepdim=True).expand_as(rewards), episode_masks)
+            ncoop_advantages = gae(rewards, episode_masks * episode_mini_masks)
+            advantages = (self.args.mean_ratio * coop_advantages) \
+                        + ((1 - self.args.mean_ratio) * ncoop_advantages)
+            returns = advantages + values.data
+        else:
+            # discounted returns of every step, restarting at episode ends, [520, 10]
+            coop_returns = discounted_returns(rewards, self.args.gamma * episode_masks)
+            ncoop_returns = discounted_returns(rewards, self.args.gamma * episode_masks * episode_mini_masks)
 
+            returns = (self.args.mean_ratio * coop_returns.mean(1, keepdim=True)) \
+                        + ((1 - self.args.mean_ratio) * ncoop_returns)
 
-        for i in reversed(range(rewards.size(0))):
-            advantages[i] = returns[i] - values.data[i]
+            advantages = returns - values.data
 
         if self.args.normalize_rewards:
             advantages = (advantages - advantages.mean()) / advantages.std()
@@ -254,17 +264,30 @@ class Trainer(object):
             stat['entropy'] = entropy.item()
             if self.args.entr > 0:
                 loss -= self.args.entr * entropy
+        self.timer.add('compute_grad', time.time() - start)
 
+        with self.timer('backward'):
+            loss.backward()
 
-        loss.backward()
+        # phase times of the batch so far, with those of env and policy_net
+        merge_stat(self.get_time_stat(), stat)
+        return stat
 
+    def get_time_stat(self):
+        '''
+        output: phase times since the last call, of this trainer, its env and policy_net
+        '''
+        stat = self.timer.get_stat()
+        for part in [self.env, self.policy_net]:
+            if hasattr(part, 'timer'):
+                merge_stat(part.timer.get_stat(), stat)
         return stat
 
     def run_batch(self, epoch):
         '''
         input: epoch
         output:
-            batch: list of Transitions from every step in batch_size = 500
+            batch: rollout.Batch of every step in batch_size = 500
             states: a dict
                 {
                     
@@ -277,24 +300,227 @@ class Trainer(object):
                     'add_rate':0.25999999999999995
                 }
         '''
-        batch = []  # list of Transitions ffrom
+        if hasattr(self.env, 'num_envs'):
+            return self.run_vector_batch(epoch)
+
+        self.buffer.clear()
+        nsteps = 0
         self.stats = dict()
         self.stats['num_episodes'] = 0
-        while len(batch) < self.args.batch_size:
-            if self.args.batch_size - len(batch) <= self.args.max_steps:
+        while nsteps < self.args.batch_size:
+            if self.args.batch_size - nsteps <= self.args.max_steps:
                 self.last_step = True
-            episode, episode_stat = self.get_episode(epoch) # episode中全是Transition
+            episode, episode_stat = self.get_episode(epoch) # episode中是buffer中的行号
             # episode_stat中包含每个episode的步数num_steps40、steps_taken40、总rewards
             merge_stat(episode_stat, self.stats)
             # self.stats中包含500步内的总步数（520）、steps_taken（500）、总rewards
             self.stats['num_episodes'] += 1
-            batch += episode
+            nsteps += len(episode)
 
         self.last_step = False
-        self.stats['num_steps'] = len(batch)    # 一个batch的总步数,其实是520
-        batch = Transition(*zip(*batch))
+        self.stats['num_steps'] = nsteps    # 一个batch的总步数,其实是520
+        batch = self.buffer.get()
+        return batch, self.stats
+
+    def run_vector_batch(self, epoch):
+        '''
+        run_batch for a VectorEnv: its K envs are stepped together with one batched forward per step.
+        Envs stop starting new episodes once the running ones are expected to fill batch_size,
+        and are started again if episodes ended early and the batch is still short.
+        With an async env (SubprocVectorEnv) the envs are split in two groups, and the forward of
+        one group runs while the other group steps.
+        output: same as run_batch, the steps of each episode are contiguous
+        '''
+        env = self.env
+        K = env.num_envs
+        n = self.args.nagents
+        hard_attn = self.args.hard_attn and self.args.commnet
+        lstm = self.args.rnn_type == 'LSTM'
+
+        self.buffer.clear()     # one lane per env
+        nsteps = 0
+        self.stats = dict()
+        self.stats['num_episodes'] = 0
+        episode_stats = [dict() for _ in range(K)]
+        infos = [dict() for _ in range(K)]
+        if hard_attn:
+            for info in infos:
+                info['comm_action'] = np.zeros(n, dtype=int)
+        active = []     # envs still collecting, started in the loop below
+        ngroups = 2 if env.is_async and K > 1 else 1
+        groups = [list(range(g, K, ngroups)) for g in range(ngroups)]
+        pending = [None] * ngroups  # forward outputs of each group, while its envs step
+
+        with self.timer('env_reset'):
+            state = env.reset(epoch)    # [K, 10, 61]
+        if self.args.recurrent:
+            # hidden states of each env as [K, 10, hid_size], tuple of (hidden, cell) for LSTM
+            if lstm:
+                hids = tuple(h.view(K, n, -1) for h in self.policy_net.init_hidden(batch_size=K))
+            else:
+                hids = (torch.zeros(K, n, self.args.hid_size),)
+
+        g = 0
+        while True:
+            if pending[g] is not None:
+                # collect the step of this group
+                group, x, action_out, value, actions, senters = pending[g]
+                pending[g] = None
+                B = len(group)
+                idx = torch.LongTensor(group)
+                with self.timer('env_step'):
+                    next_state, reward, done, step_infos = env.step_wait(group)
+                state = state.index_copy(0, idx, next_state)
+                if hard_attn:
+                    for b, info in enumerate(step_infos):
+                        info['comm_action'] = actions[b][-1] if not self.args.comm_action_one else np.ones(n, dtype=int)
+
+                next_values = dict()
+                cut = [b for b in range(B) if done[b] and step_infos[b]['truncated']]
+                if self.args.gae and len(cut) > 0:
+                    # one forward for all the envs cut by max_steps
+                    cut_idx = idx[cut]
+                    prev_hid = None
+                    if self.args.recurrent:
+                        prev_hid = tuple(h[cut_idx].view(-1, self.args.hid_size) if lstm else h[cut_idx] for h in hids)
+                        prev_hid = prev_hid if lstm else prev_hid[0]
+                    cut_state = torch.cat([step_infos[b]['terminal_obs'] for b in cut])
+                    cut_info = env.stack_info([step_infos[b] for b in cut], n)
+                    cut_senters = None if senters is None else senters[cut]
+                    next_values = dict(zip(cut, self.bootstrap_value(cut_state, prev_hid, cut_info, cut_senters)))
+
+                retire = []
+                for b, k in enumerate(group):
+                    info = step_infos[b]
+                    stat = episode_stats[k]
+
+                    if hard_attn:
+                        stat['comm_action'] = stat.get('comm_action', 0) + info['comm_action'][:self.args.nfriendly]
+                        if hasattr(self.args, 'enemy_comm') and self.args.enemy_comm:
+                            stat['enemy_comm']  = stat.get('enemy_comm', 0)  + info['comm_action'][self.args.nfriendly:]
+
+                    if 'alive_mask' in info:
+                        alive_mask = info['alive_mask'].reshape(reward[b].shape)
+                    else:
+                        alive_mask = np.ones_like(reward[b])
+
+                    stat['reward'] = stat.get('reward', 0) + reward[b][:self.args.nfriendly]
+                    if hasattr(self.args, 'enemy_comm') and self.args.enemy_comm:
+                        stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward[b][self.args.nfriendly:]
+
+                    episode_mask = np.ones(reward[b].shape)
+                    episode_mini_mask = np.ones(reward[b].shape)
+                    if done[b]:
+                        episode_mask = np.zeros(reward[b].shape)
+                    elif 'is_completed' in info:
+                        episode_mini_mask = 1 - info['is_completed'].reshape(-1)
+
+                    if self.args.continuous:
+                        env_action_out = tuple(a[b:b+1] for a in action_out)
+                    else:
+                        env_action_out = [a[b:b+1] for a in action_out]
+                    row = self.buffer.add(lane=k, state=x[b:b+1], action=actions[b], action_out=env_action_out, value=value[b:b+1],
+                                          episode_mask=episode_mask, episode_mini_mask=episode_mini_mask, reward=reward[b],
+                                          alive_mask=alive_mask, next_value=next_values.get(b))
+                    infos[k] = info
+
+                    if done[b]:
+                        reward_terminal = info['reward_terminal']
+                        self.buffer.add_reward(row, reward_terminal)
+                        stat['reward'] = stat.get('reward', 0) + reward_terminal[:self.args.nfriendly]
+                        if hasattr(self.args, 'enemy_comm') and self.args.enemy_comm:
+                            stat['enemy_reward'] = stat.get('enemy_reward', 0) + reward_terminal[self.args.nfriendly:]
+                        stat['num_steps'] = info['num_steps']
+                        stat['steps_taken'] = stat['num_steps']
+                        merge_stat(info['stat'], stat)
+                        merge_stat(stat, self.stats)
+                        self.stats['num_episodes'] += 1
+
+                        nsteps += len(self.buffer.end_episode(k))
+                        episode_stats[k] = dict()
+                        infos[k] = dict()
+                        if hard_attn:
+                            infos[k]['comm_action'] = np.zeros(n, dtype=int)
+                        # assume the other running episodes go on to max_steps
+                        running = len([j for j in active if j != k and j not in retire])
+                        if nsteps + running * self.args.max_steps >= self.args.batch_size:
+                            retire.append(k)
+
+                if self.args.recurrent and done.any():
+                    # new episodes start from zero hidden states
+                    keep = torch.ones(K)
+                    keep[idx[torch.from_numpy(done)]] = 0
+                    hids = tuple(h * keep.view(K, 1, 1) for h in hids)
+                active = [k for k in active if k not in retire]
+
+            if len(active) == 0 and all(p is None for p in pending):
+                if nsteps >= self.args.batch_size:
+                    break
+                active = list(range(min(K, -(-(self.args.batch_size - nsteps) // self.args.max_steps))))
+
+            group = [k for k in groups[g] if k in active]
+            if len(group) > 0:
+                # forward of this group, then let its envs step
+                B = len(group)
+                idx = torch.LongTensor(group)
+                x = state[idx]
+                info = env.stack_info([infos[k] for k in group], n)
+                info['env_id'] = np.array(group)    # groups shrink as envs retire, rows are not envs
+
+                if self.args.recurrent:
+                    prev_hid = tuple(h[idx].view(-1, self.args.hid_size) if lstm else h[idx] for h in hids)
+                    with self.timer('forward'):
+                        action_out, value, next_hid = self.policy_net([x, prev_hid if lstm else prev_hid[0]], info)
+                    next_hid = next_hid if lstm else (next_hid,)
+                    # detach each env every detach_gap steps of its own episode
+                    detach = torch.from_numpy((env.steps[group] + 1) % self.args.detach_gap == 0).view(B, 1, 1)
+                    next_hid = tuple(torch.where(detach, h.view(B, n, -1).detach(), h.view(B, n, -1)) for h in next_hid)
+                    hids = tuple(h.index_copy(0, idx, nh) for h, nh in zip(hids, next_hid))
+                else:
+                    with self.timer('forward'):
+                        action_out, value = self.policy_net(x, info)
+
+                with self.timer('action'):
+                    action = select_action(self.args, action_out)
+                    actions, actuals = [], []
+                    for b in range(B):
+                        a, actual = translate_action(self.args, env, action[b:b+1] if self.args.continuous else action[:, b:b+1])
+                        actions.append(a)
+                        actuals.append(actual)
+                with self.timer('env_step'):
+                    env.step_async(actuals, group)
+                # channel outcome of this forward, for the bootstrap of the envs it cuts
+                senters = getattr(self.policy_net, 'senters', None)
+                pending[g] = (group, x, action_out, value.view(B, n, -1), actions, senters)
+            g = (g + 1) % ngroups
+
+        # channel counters of this batch
+        if hasattr(self.policy_net, 'channel'):
+            merge_stat(self.policy_net.channel.get_stat(), self.stats)
+        self.stats['num_steps'] = nsteps
+        batch = self.buffer.get()
         return batch, self.stats
 
+    def bootstrap_value(self, state, prev_hid, info, senters=None):
+        '''
+        input:
+            state: tensor[B, N, obs_dim], states episodes were cut at by max_steps
+            prev_hid: hidden state for the forward of state, None if not recurrent
+            info: info for the forward of state
+            senters: tensor[B, N], channel outcome of the forward of the last step, None without a channel.
+                     It is replayed, so the bootstrap adds no contention phase to the channel stats and state
+        output:
+            value: array[B, N], value estimates to bootstrap GAE from
+        '''
+        if senters is not None:
+            info = dict(info, channel_senters=senters)
+        with torch.no_grad(), self.timer('forward'):
+            if self.args.recurrent:
+                value = self.policy_net([state, prev_hid], info)[1]
+            else:
+                value = self.policy_net(state, info)[1]
+        return value.view(state.size(0), -1).numpy()
+
     # only used when nprocesses=1
     def train_batch(self, epoch):
         '''
@@ -316,7 +542,7 @@ class Trainer(object):
                 }
         '''
         batch, stat = self.run_batch(epoch) 
-        # batch is a single Transition but each named element is a tuple filled with all corresponding elemtns from each Transition in the 'batch' from get_episode()
+        # batch is a rollout.Batch, each field holds all steps of the batch
         self.optimizer.zero_grad()
 
         s = self.compute_grad(batch)
@@ -324,10 +550,17 @@ class Trainer(object):
         for p in self.params:
             if p._grad is not None:
                 p._grad.data /= stat['num_steps']   # 最后stat['num_steps'] = 500
-        self.optimizer.step()
+        with self.timer('optimizer'):
+            self.optimizer.step()
+        merge_stat(self.timer.get_stat(), stat)
 
         return stat # the information for an entire batch_size = 500
 
+    def quit(self):
+        # env worker processes of a SubprocVectorEnv
+        if hasattr(self.env, 'close'):
+            self.env.close()
+
     def state_dict(self):
         return self.optimizer.state_dict()
 
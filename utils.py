@@ -28,6 +28,26 @@ def merge_stat(src, dest):  # 有则改之无则补之
             else:
                 dest[k] = [dest[k], v]
 
+def discounted_returns(rewards, discounts):
+    '''
+    input:
+        rewards: tensor[T, ...]
+        discounts: tensor like rewards, e.g. gamma * episode_mask
+    output:
+        returns: tensor like rewards, returns[t] = rewards[t] + discounts[t] * returns[t + 1], returns[T] = 0
+    reverse scan in log2(T) rounds of whole-tensor ops instead of a loop over t
+    '''
+    returns = rewards.clone()
+    discounts = discounts.clone()
+    T = returns.size(0)
+    k = 1
+    while k < T:
+        # returns[t] now sums rewards[t : t + 2k], discounts[t] is the product of discounts[t : t + 2k]
+        returns[:T-k] = returns[:T-k] + discounts[:T-k] * returns[k:]
+        discounts[:T-k] = discounts[:T-k] * discounts[k:]
+        k *= 2
+    return returns
+
 def normal_entropy(std):
     var = std.pow(2)
     entropy = 0.5 + 0.5 * torch.log(2 * var * math.pi)
@@ -83,10 +103,37 @@ def get_flat_grad_from(net, grad_grad=False):
     flat_grad = torch.cat(grads)
     return flat_grad
 
+
+def copy_flat_grad_to(params, flat_grad):
+    '''
+    write the grads of params into their slices of flat_grad, zeros for params without grad
+    '''
+    prev_ind = 0
+    for param in params:
+        flat_size = param.numel()
+        if param.grad is None:
+            flat_grad[prev_ind:prev_ind + flat_size].zero_()
+        else:
+            flat_grad[prev_ind:prev_ind + flat_size].copy_(param.grad.data.view(-1))
+        prev_ind += flat_size
+
+
+def set_flat_grad_to(params, flat_grad):
+    prev_ind = 0
+    for param in params:
+        flat_size = param.numel()
+        grad = flat_grad[prev_ind:prev_ind + flat_size].view(param.size())
+        if param.grad is None:
+            param.grad = grad.clone()
+        else:
+            param.grad.data.copy_(grad)
+        prev_ind += flat_size
+
 class Timer:
-    def __init__(self, msg, sync=False):
+    def __init__(self, msg, sync=False, stat=None):
         self.msg = msg
         self.sync = sync
+        self.stat = stat    # add the interval to stat[msg] instead of printing it
 
     def __enter__(self):
         self.start = time.time()
@@ -95,7 +142,34 @@ class Timer:
     def __exit__(self, *args):
         self.end = time.time()
         self.interval = self.end - self.start
-        print("{}: {} s".format(self.msg, self.interval))
+        if self.stat is None:
+            print("{}: {} s".format(self.msg, self.interval))
+        else:
+            self.stat[self.msg] = self.stat.get(self.msg, 0) + self.interval
+
+class PhaseTimer:
+    '''
+    Wall time of each phase of the training loop, as 'time_<phase>' stats for merge_stat
+        with self.timer('env_step'):
+            ...
+    '''
+    def __init__(self):
+        self.stat = dict()
+
+    def __call__(self, phase):
+        return Timer('time_' + phase, stat=self.stat)
+
+    def add(self, phase, interval):
+        key = 'time_' + phase
+        self.stat[key] = self.stat.get(key, 0) + interval
+
+    def get_stat(self):
+        '''
+        output: phase times since the last call
+        '''
+        stat = self.stat
+        self.stat = dict()
+        return stat
 
 def pca(X, k=2):
     X_mean = torch.mean(X,0)